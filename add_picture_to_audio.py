@@ -1,6 +1,7 @@
 import pathlib
 import sys
 import traceback
+from build_manifest import MANIFEST_FILE_NAME, BuildManifest
 
 # Import moviepy lazily with a friendly error message if it's not installed.
 # If import fails for any reason, print the traceback so we can diagnose the root cause.
@@ -82,6 +83,9 @@ def main():
     image_exts = ["png", "jpg", "jpeg", "bmp"]
 
     input_files = find_file_and_group_by_prefix(input_folder, audio_exts, image_exts)
+    # pairs whose audio, image and settings are unchanged since their video was written are skipped
+    manifest = BuildManifest(input_folder.joinpath(MANIFEST_FILE_NAME))
+    video_params = {"fps": 24, "codec": "libx264", "audio_codec": "aac", "ffmpeg_params": ["-shortest"]}
 
     for input_file_stem, file_pair in input_files.items():
         if file_pair["audio"] is None or file_pair["image"] is None:
@@ -89,6 +93,9 @@ def main():
         input_audio_file = pathlib.Path(file_pair["audio"])
         input_image_file = pathlib.Path(file_pair["image"])
         output_video_file = input_folder.joinpath(f"{input_file_stem}.mp4")
+        if manifest.is_current(input_file_stem, [input_audio_file, input_image_file], video_params):
+            print(f"Unchanged, skipping: {output_video_file}")
+            continue
 
         print(f"Using audio: {input_audio_file}")
         print(f"Using image: {input_image_file}")
@@ -141,15 +148,14 @@ def main():
             # force audio=True and add '-shortest' so the output respects audio length and doesn't drop it
             clip.write_videofile(
                 str(output_video_file),
-                fps=24,
-                codec="libx264",
                 audio=True,
-                audio_codec="aac",
-                ffmpeg_params=["-shortest"],
+                **video_params,
             )
         except Exception:
             print("Failed while writing the video file:")
             traceback.print_exc()
+        else:
+            manifest.record(input_file_stem, [input_audio_file, input_image_file], video_params, [output_video_file])
         finally:
             # close resources to ensure ffmpeg finishes writing audio streams
             try:
@@ -0,0 +1,838 @@
+import hashlib
+import io
+import pathlib
+import queue
+import struct
+import subprocess
+import threading
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+from PIL import Image, GifImagePlugin
+from moviepy.config import FFMPEG_BINARY
+from keying_engine import packed_rgb_lut
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# shortest GIF frame delay (ms) browsers play as written, shorter ones get slowed down to 100 ms
+CLEAR_FRAME_DURATION = 20
+
+
+def _to_image(frame) -> Image.Image:
+    if isinstance(frame, Image.Image):
+        return frame
+    return Image.fromarray(np.asarray(frame))
+
+
+def _write_png_chunk(fp, chunk_type: bytes, data: bytes):
+    fp.write(struct.pack(">I", len(data)))
+    fp.write(chunk_type)
+    fp.write(data)
+    fp.write(struct.pack(">I", zlib.crc32(chunk_type + data) & 0xFFFFFFFF))
+
+
+def _iter_png_chunks(png_bytes: bytes):
+    offset = len(PNG_SIGNATURE)
+    while offset < len(png_bytes):
+        length, chunk_type = struct.unpack(">I4s", png_bytes[offset:offset + 8])
+        yield chunk_type, png_bytes[offset + 8:offset + 8 + length]
+        offset += 12 + length
+
+
+def encode_png_frame(image: Image.Image, compress_level=6):
+    """
+    Encode a single RGBA image as PNG and return (IHDR data, concatenated IDAT data).
+    Pillow does the filtering and deflate in C, we only lift the chunks out of the result.
+    """
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG", compress_level=compress_level)
+    ihdr = None
+    idat = []
+    for chunk_type, data in _iter_png_chunks(buffer.getvalue()):
+        if chunk_type == b"IHDR":
+            ihdr = data
+        elif chunk_type == b"IDAT":
+            idat.append(data)
+    return ihdr, b"".join(idat)
+
+
+class GlobalPalette:
+    """
+    One GIF palette shared by every frame of an animation.
+    255 colors come from a sample of keyed frames, index 255 is reserved for transparency.
+    Frames are mapped with a precomputed (2**bits)^3 color -> palette index table and a single
+    numpy lookup per pixel, instead of quantizing every frame on its own.
+    Calling the object converts an RGBA image to a P-mode GIF frame (a GifWriter frame_converter).
+    """
+    TRANSPARENT_INDEX = 255
+
+    def __init__(self, colors, bits=6, alpha_cutoff=128):
+        colors = np.asarray(colors, dtype=np.uint8).reshape(-1, 3)[:self.TRANSPARENT_INDEX]
+        palette = np.zeros((256, 3), dtype=np.uint8)
+        palette[:len(colors)] = colors
+        self.palette_bytes = palette.tobytes()
+        self.alpha_cutoff = alpha_cutoff
+
+        # nearest palette entry for the center of every cell of the color cube, Pillow does the search in C
+        levels = 2 ** bits
+        step = 256 // levels
+        centers = (np.arange(levels) * step + step // 2).astype(np.uint8)
+        r, g, b = np.meshgrid(centers, centers, centers, indexing="ij")
+        cube = Image.fromarray(np.stack((r, g, b), axis=-1).reshape(levels * levels, levels, 3))
+        palette_image = Image.new("P", (1, 1))
+        palette_image.putpalette(colors.tobytes())
+        lut = np.asarray(cube.quantize(palette=palette_image, dither=Image.Dither.NONE))
+        self._table, self._mask, self._shift = packed_rgb_lut(lut.reshape(levels, levels, levels))
+
+    @classmethod
+    def from_frames(cls, frames, bits=6, alpha_cutoff=128, max_pixels=1_000_000):
+        """
+        Build the palette from the visible pixels of a sample of RGBA frames.
+        """
+        pixels = [np.asarray(frame)[..., :3][np.asarray(frame)[..., 3] > alpha_cutoff] for frame in frames]
+        pixels = np.concatenate(pixels) if pixels else np.zeros((0, 3), dtype=np.uint8)
+        if len(pixels) == 0:
+            pixels = np.zeros((1, 3), dtype=np.uint8)
+        if len(pixels) > max_pixels:
+            pixels = pixels[np.random.default_rng(0).choice(len(pixels), max_pixels, replace=False)]
+        sample = Image.fromarray(pixels.reshape(-1, 1, 3))
+        quantized = sample.quantize(colors=cls.TRANSPARENT_INDEX, method=Image.Quantize.MEDIANCUT)
+        colors = np.frombuffer(bytes(quantized.getpalette()[:3 * cls.TRANSPARENT_INDEX]), dtype=np.uint8)
+        return cls(colors, bits=bits, alpha_cutoff=alpha_cutoff)
+
+    def __call__(self, frame):
+        rgba = np.ascontiguousarray(np.asarray(frame.convert("RGBA") if isinstance(frame, Image.Image) else frame))
+        index = (rgba.view(np.uint32)[..., 0] & self._mask) >> self._shift
+        indices = self._table[index]
+        indices[rgba[..., 3] <= self.alpha_cutoff] = self.TRANSPARENT_INDEX
+
+        image = Image.frombytes("P", (indices.shape[1], indices.shape[0]), indices.tobytes())
+        image.putpalette(self.palette_bytes)
+        image.info["transparency"] = self.TRANSPARENT_INDEX
+        return image
+
+
+def _mask_rect(mask):
+    """
+    (x0, y0, x1, y1) around the set pixels of `mask`, a 1x1 rect at the origin if there are none.
+    """
+    x, y, width, height = cv2.boundingRect(mask.view(np.uint8))
+    if width == 0 or height == 0:
+        return 0, 0, 1, 1
+    return x, y, x + width, y + height
+
+
+def _union_rect(a, b):
+    return min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])
+
+
+class _PendingGifFrame:
+    """
+    A delta GIF frame held back until the next frame decides its disposal.
+    """
+
+    def __init__(self, frame, indices, shown, base, duration, rect):
+        self.frame = frame
+        self.indices = indices
+        self.shown = shown
+        self.base = base
+        self.duration = duration
+        self.rect = rect
+        self.disposal = 1
+
+
+class GifWriter:
+    """
+    Incremental animated GIF writer.
+    Every frame is LZW-encoded and written to disk as soon as it arrives,
+    so memory use does not grow with the length of the animation.
+
+    Frames must be P-mode images with a "transparency" index in their info
+    (e.g. the output of rgba_to_gif_frame) unless `frame_converter` is given,
+    which is called on every incoming frame to produce such an image.
+
+    With a `global_palette` (GlobalPalette) its palette is written once as the global color
+    table, frames are mapped through it and carry no local color table.
+
+    With `delta=True` only the rectangle that changed since the previous frame is stored, pixels
+    inside it that did not change are set to the transparency index (long runs LZW compresses
+    well) and identical frames are merged into one longer frame. The disposal of every frame is
+    chosen when the next one is known: 1 (keep) normally. When pixels have to turn transparent
+    again the last CLEAR_FRAME_DURATION ms of the previous frame become an empty frame with
+    disposal 2 over just those pixels (or, for very short frames, the previous frame itself gets
+    disposal 2 over a grown rectangle). `disposal` is ignored then.
+    `delta_tolerance` > 0 also treats pixels whose color moved by at most that much per channel
+    as unchanged (lossy, but keeps noisy footage from re-sending every pixel).
+    """
+
+    def __init__(self,
+                 path,
+                 duration=66,
+                 loop=0,
+                 disposal=2,
+                 frame_converter=None,
+                 global_palette=None,
+                 delta=False,
+                 delta_tolerance=0):
+        self.path = path
+        self.duration = duration
+        self.loop = loop
+        self.disposal = disposal
+        self.global_palette = global_palette
+        self.frame_converter = frame_converter or global_palette
+        self.delta = delta
+        self.delta_tolerance = delta_tolerance
+        self.frame_count = 0
+        self._fp = None
+        self._size = None
+        self._pending = None
+
+    def _write_header(self, size):
+        self._fp = open(self.path, "wb")
+        if self.global_palette is not None:
+            # 256 entry global color table
+            self._fp.write(b"GIF89a" + struct.pack("<HH", size[0], size[1]) + bytes((0xF7, 0, 0)))
+            self._fp.write(self.global_palette.palette_bytes)
+        else:
+            # Logical screen without a global color table, every frame carries its own palette
+            self._fp.write(b"GIF89a" + struct.pack("<HH", size[0], size[1]) + bytes((0, 0, 0)))
+        if self.loop is not None:
+            self._fp.write(b"!\xff\x0bNETSCAPE2.0\x03\x01" + struct.pack("<H", self.loop) + b"\x00")
+
+    def write(self, frame, duration=None, offset=(0, 0)):
+        """
+        Append a frame, optionally as a sub-rectangle placed at `offset` on the canvas.
+        The canvas size is taken from the first frame.
+        """
+        if self.frame_converter is not None:
+            frame = self.frame_converter(_to_image(frame))
+        if frame.mode != "P":
+            raise ValueError(f"GifWriter expects P-mode frames, got {frame.mode}")
+        if self._fp is None:
+            self._size = frame.size
+            self._write_header(frame.size)
+        duration = self.duration if duration is None else duration
+
+        if self.delta and frame.info.get("transparency") is not None:
+            self._write_delta(frame, duration, offset)
+        else:
+            self._write_frame(frame, duration, offset, frame.info.get("disposal", self.disposal))
+
+    def _write_frame(self, frame, duration, offset, disposal):
+        params = {
+            "duration": duration,
+            "disposal": disposal,
+            "include_color_table": self.global_palette is None,
+        }
+        if frame.info.get("transparency") is not None:
+            params["transparency"] = frame.info["transparency"]
+        for data in GifImagePlugin.getdata(frame, offset=offset, **params):
+            self._fp.write(data)
+        self.frame_count += 1
+
+    def _canvas_frame(self, frame, offset):
+        """
+        Indices of `frame` on the whole canvas (transparent outside the frame) and what a decoder
+        shows for them, as one uint32 per pixel: packed RGB with 0xFF top byte, 0 if transparent.
+        """
+        transparency = frame.info["transparency"]
+        palette = np.zeros((256, 3), dtype=np.uint32)
+        colors = np.frombuffer(bytes(frame.getpalette() or []), dtype=np.uint8).reshape(-1, 3)[:256]
+        palette[:len(colors)] = colors
+        shown = 0xFF000000 | palette[:, 0] | (palette[:, 1] << 8) | (palette[:, 2] << 16)
+        shown[transparency] = 0
+
+        width, height = self._size
+        indices = np.full((height, width), transparency, dtype=np.uint8)
+        x, y = offset
+        indices[y:y + frame.size[1], x:x + frame.size[0]] = np.asarray(frame)
+        return indices, shown[indices]
+
+    def _write_delta(self, frame, duration, offset):
+        indices, shown = self._canvas_frame(frame, offset)
+        pending = self._pending
+        clear_rect = None
+        if pending is None:
+            base = np.zeros_like(shown)
+        else:
+            base = pending.shown
+            # pixels that have to turn transparent can only be cleared by a disposal=2 frame covering them
+            clears = (shown == 0) & (base != 0)
+            if clears.any():
+                clear_rect = _mask_rect(clears)
+                if pending.duration < 2 * CLEAR_FRAME_DURATION:
+                    clear_rect = _union_rect(pending.rect, clear_rect)
+                base = base.copy()
+                x0, y0, x1, y1 = clear_rect
+                base[y0:y1, x0:x1] = 0
+        if self.delta_tolerance:
+            shown = self._keep_similar(shown, base)
+
+        if pending is not None:
+            if clear_rect is None and np.array_equal(shown, base):
+                pending.duration += duration
+                return
+            if clear_rect is None:
+                pending.disposal = 1
+                self._flush_pending()
+            elif pending.duration < 2 * CLEAR_FRAME_DURATION:
+                # too short to split, dispose the previous frame over its rect grown by the cleared pixels
+                pending.rect = clear_rect
+                pending.disposal = 2
+                self._flush_pending()
+            else:
+                # disposing the previous frame would clear everything it drew and force a redraw of it,
+                # instead end its display time with a short empty frame that clears just these pixels
+                pending.disposal = 1
+                pending.duration -= CLEAR_FRAME_DURATION
+                palette = pending.frame.getpalette()
+                transparency = pending.frame.info["transparency"]
+                self._flush_pending()
+                self._write_empty_frame(clear_rect, palette, transparency)
+
+        self._pending = _PendingGifFrame(frame, indices, shown, base, duration, _mask_rect(shown != base))
+
+    def _write_empty_frame(self, rect, palette, transparency):
+        x0, y0, x1, y1 = rect
+        image = Image.new("P", (x1 - x0, y1 - y0), transparency)
+        image.putpalette(palette)
+        image.info["transparency"] = transparency
+        self._write_frame(image, CLEAR_FRAME_DURATION, (x0, y0), 2)
+
+    def _keep_similar(self, shown, base):
+        """
+        Opaque pixels within `delta_tolerance` of what is already on the canvas keep showing the
+        old color (they are written as transparent), so sensor noise does not count as a change.
+        """
+        height, width = shown.shape
+        difference = cv2.absdiff(shown.view(np.uint8).reshape(height, width, 4),
+                                 base.view(np.uint8).reshape(height, width, 4))
+        similar = difference[..., :3].max(axis=-1) <= self.delta_tolerance
+        similar &= (shown != 0) & (base != 0)
+        return np.where(similar, base, shown)
+
+    def _flush_pending(self):
+        pending = self._pending
+        x0, y0, x1, y1 = pending.rect
+        transparency = pending.frame.info["transparency"]
+        region = pending.indices[y0:y1, x0:x1].copy()
+        region[pending.shown[y0:y1, x0:x1] == pending.base[y0:y1, x0:x1]] = transparency
+
+        image = Image.frombytes("P", (x1 - x0, y1 - y0), region.tobytes())
+        image.putpalette(pending.frame.getpalette())
+        image.info["transparency"] = transparency
+        self._write_frame(image, pending.duration, (x0, y0), pending.disposal)
+        self._pending = None
+
+    def close(self):
+        if self._fp is None:
+            return
+        if self._pending is not None:
+            # leave an empty canvas behind so the next loop starts like the first one
+            self._pending.rect = _union_rect(self._pending.rect, _mask_rect(self._pending.shown != 0))
+            self._pending.disposal = 2
+            self._flush_pending()
+        self._fp.write(b";")
+        self._fp.close()
+        self._fp = None
+
+    def abort(self):
+        """
+        Stop writing and delete the partial file.
+        """
+        self._pending = None
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+        pathlib.Path(self.path).unlink(missing_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class _PendingApngFrame:
+    """
+    An APNG frame whose compression may still be running on the writer's thread pool.
+    """
+
+    def __init__(self, encoded, size, offset, duration, blend_op=0):
+        self.encoded = encoded
+        self.size = size
+        self.offset = offset
+        self.duration = duration
+        self.blend_op = blend_op
+
+
+def _to_rgba_array(frame):
+    if isinstance(frame, np.ndarray) and frame.dtype == np.uint8 and frame.ndim == 3 and frame.shape[2] == 4:
+        return np.ascontiguousarray(frame)
+    image = _to_image(frame)
+    if image.mode != "RGBA":
+        image = image.convert("RGBA")
+    return np.asarray(image)
+
+
+def frame_digest(rgba) -> bytes:
+    """
+    16 byte BLAKE2b digest of a frame's shape and pixels, equal for identical frames.
+    """
+    rgba = np.ascontiguousarray(rgba)
+    digest = hashlib.blake2b(str(rgba.shape).encode(), digest_size=16)
+    digest.update(memoryview(rgba).cast("B"))
+    return digest.digest()
+
+
+def _encode_rgba(rgba, compress_level):
+    return encode_png_frame(Image.fromarray(rgba), compress_level=compress_level)
+
+
+class ApngWriter:
+    """
+    Incremental animated PNG writer.
+    Frames (RGBA numpy arrays or PIL images) are handed to a thread pool for compression as soon
+    as they arrive and appended as fcTL/fdAT chunks in order. The frame count in acTL is patched
+    in when the writer is closed.
+
+    dispose_op: 0 keeps a frame on the canvas, 1 clears its area before the next frame
+                (use 1 when frames are sub-rectangles that each hold everything visible).
+    delta: compare every frame with the canvas a player shows at that point and only store the
+           bounding box of the changed pixels. When every changed pixel is opaque, unchanged pixels
+           inside the box are stored transparent and blended over the canvas, which compresses
+           far better. Frames identical to the canvas extend the previous frame's duration
+           instead of being stored (like Pillow's APNG encoder does). The decoded animation
+           is unchanged.
+    workers: compression threads (zlib releases the GIL), defaults to OpenCV's thread count, the
+             CPU count unless lowered with cv2.setNumThreads (e.g. per batch worker process).
+    encode_cache_size: frames (or delta regions) that repeat later in the animation are recognized
+                       by their frame_digest and compressed only once, the last this many
+                       compressed frames are kept for that.
+    """
+
+    def __init__(self, path, duration=66, loop=0, compress_level=6, dispose_op=0, delta=False, workers=None,
+                 encode_cache_size=256):
+        self.path = path
+        self.duration = duration
+        self.loop = loop
+        self.compress_level = compress_level
+        self.dispose_op = dispose_op
+        self.delta = delta
+        self.frame_count = 0
+        self._sequence = 0
+        self._actl_offset = None
+        self._size = None
+        self._fp = None
+        self._canvas = None
+        self._pending = deque()
+        workers = workers or cv2.getNumThreads() or 1
+        self._max_pending = 2 * workers
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._encode_cache_size = encode_cache_size
+        self._encoded = OrderedDict()
+
+    def _encode(self, rgba, copy):
+        """
+        Future of the compressed frame, shared with an earlier identical frame when there is one.
+        """
+        key = frame_digest(rgba)
+        encoded = self._encoded.get(key)
+        if encoded is not None:
+            self._encoded.move_to_end(key)
+            return encoded
+        encoded = self._executor.submit(_encode_rgba, rgba.copy() if copy else rgba, self.compress_level)
+        if self._encode_cache_size:
+            self._encoded[key] = encoded
+            if len(self._encoded) > self._encode_cache_size:
+                self._encoded.popitem(last=False)
+        return encoded
+
+    def _write_header(self, ihdr):
+        self._fp = open(self.path, "wb")
+        self._fp.write(PNG_SIGNATURE)
+        _write_png_chunk(self._fp, b"IHDR", ihdr)
+        self._actl_offset = self._fp.tell()
+        _write_png_chunk(self._fp, b"acTL", struct.pack(">II", 0, self.loop))
+
+    def _write_frame_control(self, size, offset, duration, blend_op=0):
+        duration = int(duration)
+        delay_den = 1000
+        if duration > 0xFFFF:
+            # the delay numerator is 16 bit, long pauses lose their last digit instead
+            duration, delay_den = min(0xFFFF, round(duration / 10)), 100
+        data = struct.pack(">IIIIIHHBB",
+                           self._sequence,
+                           size[0], size[1],
+                           offset[0], offset[1],
+                           duration, delay_den,
+                           0 if self.delta else self.dispose_op,
+                           blend_op)  # 0: source, 1: over
+        _write_png_chunk(self._fp, b"fcTL", data)
+        self._sequence += 1
+
+    def write(self, frame, duration=None, offset=(0, 0)):
+        """
+        Append a frame, optionally as a sub-rectangle placed at `offset` on the canvas.
+        The canvas size is taken from the first frame, which has to cover the whole canvas.
+        """
+        duration = self.duration if duration is None else duration
+        rgba = _to_rgba_array(frame)
+        height, width = rgba.shape[:2]
+        offset = (int(offset[0]), int(offset[1]))
+        if self._size is None:
+            if offset != (0, 0):
+                raise ValueError("The first APNG frame has to start at (0, 0)")
+            self._size = (width, height)
+        elif offset[0] + width > self._size[0] or offset[1] + height > self._size[1]:
+            raise ValueError(f"APNG frame {(width, height)} at {offset} does not fit the canvas {self._size}")
+
+        blend_op = 0
+        if self.delta:
+            rgba, offset, blend_op = self._changed_region(rgba, offset)
+            if rgba is None:
+                self._pending[-1].duration += duration
+                return
+
+        # without delta the caller may reuse its buffer while the frame is still being compressed
+        encoded = self._encode(rgba, copy=not self.delta)
+        self._pending.append(_PendingApngFrame(encoded, (rgba.shape[1], rgba.shape[0]), offset, duration, blend_op))
+        while len(self._pending) > self._max_pending:
+            self._write_pending()
+
+    def _changed_region(self, rgba, offset):
+        """
+        Apply a frame to the tracked canvas and return (changed region, its offset, blend_op),
+        or (None, None, None) when the frame changes nothing.
+        """
+        if self._canvas is None:
+            self._canvas = rgba.copy()
+            return rgba.copy(), offset, 0
+
+        height, width = rgba.shape[:2]
+        if offset == (0, 0) and (width, height) == self._size:
+            target = rgba
+        else:
+            target = np.zeros_like(self._canvas) if self.dispose_op == 1 else self._canvas.copy()
+            target[offset[1]:offset[1] + height, offset[0]:offset[0] + width] = rgba
+
+        changed = target.view(np.uint32)[:, :, 0] != self._canvas.view(np.uint32)[:, :, 0]
+        if not changed.any():
+            return None, None, None
+        x0, y0, x1, y1 = _mask_rect(changed)
+        region = target[y0:y1, x0:x1].copy()
+        self._canvas[y0:y1, x0:x1] = region
+        changed = changed[y0:y1, x0:x1]
+        # blending over the canvas only reproduces a pixel exactly when the new pixel is opaque
+        # or fully transparent and unchanged, so fall back to replacing the box otherwise
+        if np.all(region[:, :, 3][changed] == 255):
+            region[~changed] = 0
+            return region, (x0, y0), 1
+        return region, (x0, y0), 0
+
+    def _write_pending(self):
+        pending = self._pending.popleft()
+        ihdr, idat = pending.encoded.result()
+        if self._fp is None:
+            self._write_header(ihdr)
+        self._write_frame_control(pending.size, pending.offset, pending.duration, pending.blend_op)
+        if self.frame_count == 0:
+            _write_png_chunk(self._fp, b"IDAT", idat)
+        else:
+            _write_png_chunk(self._fp, b"fdAT", struct.pack(">I", self._sequence) + idat)
+            self._sequence += 1
+        self.frame_count += 1
+
+    def close(self):
+        try:
+            while self._pending:
+                self._write_pending()
+        finally:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            if self._fp is not None:
+                _write_png_chunk(self._fp, b"IEND", b"")
+                self._fp.seek(self._actl_offset)
+                _write_png_chunk(self._fp, b"acTL", struct.pack(">II", self.frame_count, self.loop))
+                self._fp.close()
+                self._fp = None
+
+    def abort(self):
+        """
+        Stop writing, drop the frames still being compressed and delete the partial file.
+        """
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        self._pending.clear()
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+        pathlib.Path(self.path).unlink(missing_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class PngSequenceWriter:
+    """
+    Write every frame as its own PNG (frame_00000.png, frame_00001.png, ...) into `folder`.
+    Cropped frames are written as they are, their offsets are not applied.
+    """
+
+    def __init__(self, folder, name_format="frame_{:05d}.png", compress_level=6):
+        self.folder = pathlib.Path(folder)
+        self.name_format = name_format
+        self.compress_level = compress_level
+        self.frame_count = 0
+
+    def write(self, frame, duration=None, offset=(0, 0)):
+        _to_image(frame).save(self.folder.joinpath(self.name_format.format(self.frame_count)),
+                              compress_level=self.compress_level)
+        self.frame_count += 1
+
+    def close(self):
+        pass
+
+    def abort(self):
+        """
+        Delete the frames written so far.
+        """
+        for index in range(self.frame_count):
+            self.folder.joinpath(self.name_format.format(index)).unlink(missing_ok=True)
+        self.frame_count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+# ffmpeg output arguments for video formats that keep the alpha channel
+VIDEO_CODECS = {
+    "vp9": ["-c:v", "libvpx-vp9", "-pix_fmt", "yuva420p", "-b:v", "0", "-crf", "30",
+            "-row-mt", "1", "-auto-alt-ref", "0"],
+    "prores": ["-c:v", "prores_ks", "-profile:v", "4444", "-pix_fmt", "yuva444p10le",
+               "-alpha_bits", "16", "-vendor", "apl0"],
+}
+
+
+class FfmpegVideoWriter:
+    """
+    Pipe raw RGBA frames into ffmpeg to encode a video with alpha channel:
+    codec "vp9" for WebM (VP9 with alpha), "prores" for ProRes 4444 in a .mov.
+    The video has a constant frame rate `fps`, a frame with a longer `duration` is repeated.
+    Frames smaller than the first one are drawn at their offset on an otherwise transparent canvas.
+    """
+
+    def __init__(self, path, fps=15, codec="vp9"):
+        if codec not in VIDEO_CODECS:
+            raise ValueError(f"Unknown video codec: {codec}")
+        self.path = str(path)
+        self.fps = fps
+        self.codec = codec
+        self.frame_count = 0
+        self._size = None
+        self._canvas = None
+        self._process = None
+
+    def _start(self, width, height):
+        command = [FFMPEG_BINARY, "-nostdin", "-loglevel", "error", "-y",
+                   "-f", "rawvideo", "-pix_fmt", "rgba", "-s", f"{width}x{height}", "-r", str(self.fps),
+                   "-i", "-", "-an"] + VIDEO_CODECS[self.codec] + [self.path]
+        self._size = (width, height)
+        self._canvas = np.zeros((height, width, 4), dtype=np.uint8)
+        self._process = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def write(self, frame, duration=None, offset=(0, 0)):
+        rgba = _to_rgba_array(frame)
+        height, width = rgba.shape[:2]
+        if self._process is None:
+            self._start(width, height)
+        if (width, height) != self._size:
+            self._canvas[:] = 0
+            self._canvas[offset[1]:offset[1] + height, offset[0]:offset[0] + width] = rgba
+            rgba = self._canvas
+
+        repeat = 1 if duration is None else max(1, round(duration * self.fps / 1000))
+        try:
+            for _ in range(repeat):
+                self._process.stdin.write(memoryview(rgba).cast("B"))
+        except BrokenPipeError:
+            raise IOError(f"ffmpeg stopped encoding {self.path}: "
+                          f"{self._process.stderr.read().decode(errors='replace')}")
+        self.frame_count += repeat
+
+    def close(self):
+        if self._process is None:
+            return
+        process = self._process
+        self._process = None
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+        errors = process.stderr.read()
+        process.stderr.close()
+        if process.wait() != 0:
+            raise IOError(f"ffmpeg failed to encode {self.path}: {errors.decode(errors='replace')}")
+
+    def abort(self):
+        """
+        Stop ffmpeg and delete the partial video.
+        """
+        if self._process is not None:
+            process = self._process
+            self._process = None
+            process.kill()
+            process.wait()
+            process.stdin.close()
+            process.stderr.close()
+        pathlib.Path(self.path).unlink(missing_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class DedupWriter:
+    """
+    Collapse runs of identical consecutive frames in front of another writer: a frame equal to
+    the previous one (same pixels and offset) only adds its duration to it, so the run is
+    converted and encoded once as one longer frame. The last frame is held back until a
+    different one arrives or the writer is closed.
+    Only for writers that take per-frame durations (ApngWriter, GifWriter), not for ones that
+    need every frame (PngSequenceWriter) or a constant frame rate (FfmpegVideoWriter).
+    """
+
+    # the held frame is written after write() returns, see keying_engine.save_frames
+    keeps_frames = True
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.merged_frames = 0
+        self._held = None
+
+    def write(self, frame, duration=None, offset=(0, 0)):
+        duration = self.writer.duration if duration is None else duration
+        rgba = _to_rgba_array(frame)
+        held = self._held
+        if held is not None and held[3] == tuple(offset) and np.array_equal(held[1], rgba):
+            held[2] += duration
+            self.merged_frames += 1
+            return
+        self._flush()
+        self._held = [frame, rgba, duration, tuple(offset)]
+
+    def _flush(self):
+        if self._held is not None:
+            frame, _, duration, offset = self._held
+            self._held = None
+            self.writer.write(frame, duration=duration, offset=offset)
+
+    def close(self):
+        try:
+            self._flush()
+        finally:
+            self.writer.close()
+
+    def abort(self):
+        self._held = None
+        self.writer.abort()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class ThreadedWriter:
+    """
+    Run another writer on its own thread behind a bounded queue, so several output formats
+    encode in parallel and the keying loop only waits when a writer falls `queue_size` frames behind.
+    Frames are passed on as they are: the caller must not modify a frame after writing it.
+    An error in the writer thread is raised again from the next write() or from close().
+    """
+
+    # frames are written after write() returns, see keying_engine.save_frames
+    keeps_frames = True
+
+    def __init__(self, writer, queue_size=8):
+        self.writer = writer
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._error = None
+        self._aborted = False
+        self._thread = threading.Thread(target=self._run, name=f"{type(writer).__name__}-thread", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if self._error is not None or self._aborted:
+                continue  # keep draining so the producer never blocks on a dead writer
+            try:
+                self.writer.write(item[0], duration=item[1], offset=item[2])
+            except BaseException as error:
+                self._error = error
+
+    def write(self, frame, duration=None, offset=(0, 0)):
+        if self._error is not None:
+            raise self._error
+        self._queue.put((frame, duration, offset))
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self.writer.close()
+        if self._error is not None:
+            raise self._error
+
+    def abort(self):
+        """
+        Drop the queued frames, wait for the frame being written and abort the wrapped writer.
+        """
+        self._aborted = True
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self.writer.abort()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def close_writers(writers):
+    """
+    Close every writer even if some fail, then raise the first error.
+    """
+    first_error = None
+    for writer in writers:
+        try:
+            writer.close()
+        except Exception as error:
+            first_error = first_error or error
+    if first_error is not None:
+        raise first_error
+
+
+def abort_writers(writers):
+    """
+    Abort every writer after a failed run, so no partial output is left that looks complete.
+    Errors while aborting are ignored, the error that stopped the run is the one to report.
+    """
+    for writer in writers:
+        try:
+            writer.abort()
+        except Exception:
+            pass
@@ -0,0 +1,236 @@
+import json
+import multiprocessing
+import os
+import pathlib
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import cv2
+from PIL import Image
+from moviepy.config import FFMPEG_BINARY
+from animation_writer import ApngWriter, GlobalPalette
+from ffmpeg_decoder import FfmpegFrameReader
+from keying_engine import ChromaKeyer, apply_mask, expand_transparency, rgba_to_gif_frame
+from pipeline_profiler import peak_rss_mb
+from remove_greenscreen_from_video import handle_video_file
+
+current_path = pathlib.Path(__file__).parent
+FIXTURE_FOLDER = current_path.joinpath("data", "cache", "benchmark")
+BASELINE_FILE = current_path.joinpath("data", "benchmark", "baseline.json")
+
+# (name, width, height, frames) of the synthetic clips, all at 30 fps
+FIXTURES = [
+    ("small_360p", 640, 360, 90),
+    ("medium_720p", 1280, 720, 60),
+    ("large_1080p", 1920, 1080, 30),
+]
+LOWER = (37, 40, 40)
+UPPER = (85, 255, 255)
+
+
+def synthetic_greenscreen_frames(width, height, frame_count, seed=0):
+    """
+    Green screen test frames: uneven green backdrop, a textured subject walking across the frame
+    with a moving head, green spill on the subject's edge and per-frame sensor noise.
+    """
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:height, 0:width].astype(np.float32)
+    backdrop = np.empty((height, width, 3), dtype=np.float32)
+    shading = 1.0 - 0.25 * ((xx - width / 2) ** 2 + (yy - height / 2) ** 2) / (width * width / 4)
+    backdrop[:, :, 0] = 35 * shading
+    backdrop[:, :, 1] = 190 * shading
+    backdrop[:, :, 2] = 60 * shading
+    texture = np.stack([150 + 40 * np.sin(xx / 9) * np.cos(yy / 7),
+                        100 + 30 * np.cos(xx / 13),
+                        80 + 30 * np.sin(yy / 11)], axis=-1)
+
+    for index in range(frame_count):
+        phase = index / max(1, frame_count - 1)
+        center_x = width * (0.25 + 0.5 * phase)
+        body = ((xx - center_x) / (width * 0.12)) ** 2 + ((yy - height * 0.75) / (height * 0.35)) ** 2
+        head = (((xx - center_x - width * 0.01 * np.sin(index / 4)) / (width * 0.05)) ** 2
+                + ((yy - height * 0.3) / (height * 0.1)) ** 2)
+        inside = np.minimum(body, head)
+        subject = (inside < 1.0).astype(np.float32)[:, :, None]
+        # spill: the backdrop bleeds into the outer rim of the subject
+        spill = np.clip((inside - 0.75) / 0.25, 0, 1)[:, :, None] * subject * 0.6
+        frame = backdrop * (1 - subject) + (texture * (1 - spill) + backdrop * spill) * subject
+        frame += rng.normal(0, 3, frame.shape).astype(np.float32)
+        yield np.clip(frame, 0, 255).astype(np.uint8)
+
+
+def make_fixture(name, width, height, frame_count, fps=30, fixture_folder=FIXTURE_FOLDER):
+    """
+    Encode the synthetic clip `name` with ffmpeg (H.264, 2 s GOP) once and return its path.
+    """
+    path = pathlib.Path(fixture_folder).joinpath(f"{name}.mp4")
+    if path.exists():
+        return path
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_suffix(".tmp.mp4")
+    command = [FFMPEG_BINARY, "-nostdin", "-loglevel", "error", "-y",
+               "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{width}x{height}", "-r", str(fps), "-i", "-",
+               "-c:v", "libx264", "-preset", "fast", "-crf", "18", "-g", str(2 * fps), "-pix_fmt", "yuv420p",
+               str(temp_path)]
+    process = subprocess.Popen(command, stdin=subprocess.PIPE)
+    for frame in synthetic_greenscreen_frames(width, height, frame_count):
+        process.stdin.write(frame.tobytes())
+    process.stdin.close()
+    if process.wait() != 0:
+        raise IOError(f"ffmpeg failed to encode the benchmark fixture {path}")
+    temp_path.replace(path)
+    return path
+
+
+def _frames_per_second(function, items, repeat=3):
+    # best of `repeat` passes, the fastest pass is the one least disturbed by other processes
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for item in items:
+            function(item)
+        best = min(best, time.perf_counter() - start)
+    return round(len(items) / best, 2)
+
+
+def benchmark_stages(path):
+    """
+    Frames/s of every keying stage on the decoded frames of `path` (all frames held in memory).
+    """
+    stages = {}
+    start = time.perf_counter()
+    frames = [frame.copy() for frame in FfmpegFrameReader(path)]
+    stages["decode_ffmpeg"] = round(len(frames) / (time.perf_counter() - start), 2)
+
+    masked = [apply_mask(frame, LOWER, UPPER) for frame in frames]
+    stages["apply_mask"] = _frames_per_second(lambda frame: apply_mask(frame, LOWER, UPPER), frames)
+    stages["expand_transparency"] = _frames_per_second(
+        lambda rgba: expand_transparency(rgba, shrink_pixels=1, feather=1), masked)
+    for key_mode in ("hsv", "lut"):
+        keyer = ChromaKeyer(LOWER, UPPER, shrink_pixels=1, feather=1, key_mode=key_mode)
+        stages[f"chroma_keyer_{key_mode}"] = _frames_per_second(keyer.key, frames)
+
+    keyer = ChromaKeyer(LOWER, UPPER, shrink_pixels=1, feather=1)
+    images = [Image.fromarray(keyer.key(frame).copy()) for frame in frames]
+    stages["rgba_to_gif_frame"] = _frames_per_second(rgba_to_gif_frame, images)
+    palette = GlobalPalette.from_frames([np.asarray(image) for image in images[::max(1, len(images) // 8)]])
+    stages["global_palette"] = _frames_per_second(palette, images)
+    with tempfile.TemporaryDirectory() as temp_folder:
+        with ApngWriter(pathlib.Path(temp_folder).joinpath("bench.png"), delta=True) as writer:
+            start = time.perf_counter()
+            for image in images:
+                writer.write(image)
+        stages["apng_delta"] = round(len(images) / (time.perf_counter() - start), 2)
+    return stages
+
+
+def _run_end_to_end(path, options):
+    with tempfile.TemporaryDirectory() as temp_folder:
+        start = time.perf_counter()
+        handle_video_file(input_path=path, output_path=pathlib.Path(temp_folder), lower=LOWER, upper=UPPER, **options)
+        seconds = time.perf_counter() - start
+    return seconds, peak_rss_mb()
+
+
+def benchmark_end_to_end(path, options):
+    """
+    Wall time and peak RSS of one handle_video_file run, in a fresh process so the peak is its own.
+    """
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        seconds, peak_rss = pool.apply(_run_end_to_end, (path, options))
+    return {"seconds": round(seconds, 3), "peak_rss_mb": round(peak_rss, 1) if peak_rss is not None else None}
+
+
+def run_benchmarks(fixtures=FIXTURES, end_to_end_options=None):
+    """
+    Benchmark every fixture and return a JSON-serializable result.
+    """
+    if end_to_end_options is None:
+        end_to_end_options = {"fps_out": 15, "sape_png": True, "save_gif": True, "decoder": "ffmpeg"}
+    results = {
+        "machine": {"python": platform.python_version(),
+                    "numpy": np.__version__,
+                    "opencv": cv2.__version__,
+                    "platform": platform.platform(),
+                    "cpu_count": os.cpu_count()},
+        "end_to_end_options": end_to_end_options,
+        "fixtures": {},
+    }
+    for name, width, height, frame_count in fixtures:
+        path = make_fixture(name, width, height, frame_count)
+        print(f"Benchmarking {name} ({width}x{height}, {frame_count} frames)")
+        results["fixtures"][name] = {"stages_fps": benchmark_stages(path),
+                                     "end_to_end": benchmark_end_to_end(path, end_to_end_options)}
+    return results
+
+
+def compare_results(baseline, current, threshold=0.2):
+    """
+    List regressions of `current` against `baseline`: a stage whose frames/s dropped, or an
+    end-to-end time / peak RSS that grew, by more than `threshold` (0.2 = 20%).
+    """
+    regressions = []
+    for name, base in baseline["fixtures"].items():
+        result = current["fixtures"].get(name)
+        if result is None:
+            continue
+        for stage, base_fps in base["stages_fps"].items():
+            fps = result["stages_fps"].get(stage)
+            if fps is not None and fps < base_fps * (1 - threshold):
+                regressions.append(f"{name} {stage}: {base_fps} -> {fps} frames/s ({fps / base_fps - 1:+.0%})")
+        for metric, base_value in base["end_to_end"].items():
+            value = result["end_to_end"].get(metric)
+            if value is not None and base_value is not None and value > base_value * (1 + threshold):
+                regressions.append(f"{name} end_to_end {metric}: {base_value} -> {value} "
+                                   f"({value / base_value - 1:+.0%})")
+    return regressions
+
+
+def print_results(results):
+    for name, result in results["fixtures"].items():
+        print(name)
+        for stage, fps in result["stages_fps"].items():
+            print(f"  {stage:<22}{fps:>10.1f} frames/s")
+        end_to_end = result["end_to_end"]
+        print(f"  {'end_to_end':<22}{end_to_end['seconds']:>10.3f} s  peak RSS {end_to_end['peak_rss_mb']} MB")
+
+
+def main():
+    # python benchmark_keying.py run [result.json]
+    # python benchmark_keying.py compare [baseline.json] [result.json] [threshold]
+    args = sys.argv[1:] or ["run"]
+    if args[0] == "run":
+        output_file = pathlib.Path(args[1]) if len(args) > 1 else BASELINE_FILE
+        results = run_benchmarks()
+        print_results(results)
+        output_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(output_file, "w") as fp:
+            json.dump(results, fp, indent=2)
+        print(f"Results saved to {output_file}")
+    elif args[0] == "compare":
+        baseline_file = pathlib.Path(args[1]) if len(args) > 1 else BASELINE_FILE
+        with open(baseline_file) as fp:
+            baseline = json.load(fp)
+        if len(args) > 2:
+            with open(args[2]) as fp:
+                current = json.load(fp)
+        else:
+            current = run_benchmarks(end_to_end_options=baseline.get("end_to_end_options"))
+            print_results(current)
+        threshold = float(args[3]) if len(args) > 3 else 0.2
+        regressions = compare_results(baseline, current, threshold)
+        for regression in regressions:
+            print("SLOWER", regression)
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions above {threshold:.0%} against {baseline_file}")
+    else:
+        print(f"Unknown command: {args[0]}")
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
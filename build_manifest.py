@@ -0,0 +1,88 @@
+import hashlib
+import json
+import os
+import pathlib
+
+MANIFEST_FILE_NAME = "manifest.json"
+
+
+def file_digest(path, chunk_size=1 << 20) -> str:
+    """
+    SHA-256 of the content of `path`, read in chunks.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _normalized(params):
+    # tuples and lists, paths and strings compare equal once they went through JSON
+    return json.loads(json.dumps(params, sort_keys=True, default=str))
+
+
+class BuildManifest:
+    """
+    Record of the work a batch converter already did, kept as JSON at `path`: for every job
+    (`key`, e.g. the input file) the content hash of its input files, the processing parameters
+    and the outputs it produced. A job is up to date when the hashes and parameters match and
+    all outputs still exist, so a re-run only processes new or changed inputs.
+    Hashes are reused while a file's size and mtime are unchanged, a file that was only touched
+    is hashed again and still counts as unchanged when its content is.
+    The file is rewritten after every record(), an interrupted batch keeps the finished jobs.
+    """
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self.entries = {}
+        if self.path.exists():
+            with open(self.path) as fp:
+                self.entries = json.load(fp).get("entries", {})
+        self._digests = {}
+
+    def _input_records(self, key, inputs):
+        known = {record["path"]: record for record in self.entries.get(key, {}).get("inputs", [])}
+        records = []
+        for input_path in inputs:
+            input_path = str(input_path)
+            stat = os.stat(input_path)
+            stamp = (stat.st_size, stat.st_mtime_ns)
+            if input_path not in self._digests or self._digests[input_path][0] != stamp:
+                record = known.get(input_path)
+                if record is not None and (record["size"], record["mtime_ns"]) == stamp:
+                    digest = record["sha256"]
+                else:
+                    digest = file_digest(input_path)
+                self._digests[input_path] = (stamp, digest)
+            stamp, digest = self._digests[input_path]
+            records.append({"path": input_path, "size": stamp[0], "mtime_ns": stamp[1], "sha256": digest})
+        return records
+
+    def is_current(self, key, inputs, params=None) -> bool:
+        """
+        True when job `key` was recorded with the same input content and `params` and its outputs exist.
+        """
+        entry = self.entries.get(key)
+        if entry is None or entry["params"] != _normalized(params):
+            return False
+        recorded = [record["sha256"] for record in entry["inputs"]]
+        if recorded != [record["sha256"] for record in self._input_records(key, inputs)]:
+            return False
+        return all(os.path.exists(output) for output in entry["outputs"])
+
+    def record(self, key, inputs, params=None, outputs=()):
+        """
+        Store job `key` as done and save the manifest.
+        """
+        self.entries[key] = {"inputs": self._input_records(key, inputs),
+                             "params": _normalized(params),
+                             "outputs": [str(output) for output in outputs]}
+        self.save()
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = self.path.with_suffix(".tmp")
+        with open(temp_path, "w") as fp:
+            json.dump({"entries": self.entries}, fp, indent=2)
+        os.replace(temp_path, self.path)
@@ -1,6 +1,10 @@
+import os
 import pathlib
+from collections import OrderedDict
 from PIL import Image
 import random
+import numpy as np
+from animation_writer import ApngWriter
 
 current_path = pathlib.Path(__file__).parent
 
@@ -11,12 +15,73 @@ def add_marker_pixel(img: Image.Image) -> Image.Image:
     return img
 
 
+def decode_animation(file_path) -> list:
+    """
+    All frames of an animated image as (read-only RGBA array, duration in ms) pairs.
+    """
+    frames = []
+    with Image.open(file_path) as im:
+        try:
+            i = 0
+            while True:
+                im.seek(i)
+                frame = np.asarray(im.convert("RGBA"))
+                frame.flags.writeable = False
+                # Get original frame duration if exists, otherwise default 100ms
+                frames.append((frame, im.info.get("duration", 100)))
+                i += 1
+        except EOFError:
+            pass  # reached end of this APNG
+    return frames
+
+
+class DecodedAnimationCache:
+    """
+    Decoded frames of animation files keyed by (path, mtime), so a file that is picked several
+    times, or again for the next combined output, is decoded once. The least recently used
+    animations are dropped when the cached frames take more than `max_bytes`, an animation
+    larger than that on its own is decoded every time.
+    """
+
+    def __init__(self, max_bytes=2 << 30):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._size = 0
+        self._frames = OrderedDict()
+
+    def frames(self, file_path) -> list:
+        key = (str(file_path), os.stat(file_path).st_mtime_ns)
+        frames = self._frames.get(key)
+        if frames is not None:
+            self._frames.move_to_end(key)
+            self.hits += 1
+            return frames
+        self.misses += 1
+        frames = decode_animation(file_path)
+        size = sum(frame.nbytes for frame, _ in frames)
+        if size <= self.max_bytes:
+            self._frames[key] = frames
+            self._size += size
+            while self._size > self.max_bytes:
+                _, dropped = self._frames.popitem(last=False)
+                self._size -= sum(frame.nbytes for frame, _ in dropped)
+        return frames
+
+
 def combine_animation_files(clip_amount = 35,
                             input_folder= None,
                             output_file=None,
                             min_delay=1000,
                             max_delay=10000,
-                            no_delay_change=False):
+                            no_delay_change=False,
+                            animation_cache=None):
+    """
+    animation_cache: DecodedAnimationCache to share decoded files between calls, by default
+                     every call decodes each distinct file once.
+    """
+    if animation_cache is None:
+        animation_cache = DecodedAnimationCache()
     animated_png_files = [video_file_path for video_file_path in input_folder.glob("*.png")]
 
     files_to_combine = []
@@ -32,52 +97,38 @@ def combine_animation_files(clip_amount = 35,
     # your code here
     # ---------------------------
 
-    # Load all frames from all files and track durations
-    all_frames = []
-    all_durations = []
-
-    for file_path in files_to_combine:
-        im = Image.open(file_path)
-        duration = 66
-        try:
-            i = 0
-            while True:
-                im.seek(i)
-                frame = im.convert("RGBA")
-                all_frames.append(frame)
-
-                # Get original frame duration if exists, otherwise default 100ms
-                duration = im.info.get("duration", 100)
-                all_durations.append(duration)
-
-                i += 1
-        except EOFError:
-            pass  # reached end of this APNG
-
-        # Add a random delay after this file
-        delay_between_files = random.randint(min_delay, max_delay)
-        if no_delay_change:
-            delay_amount = int(delay_between_files // duration)
-            for _ in range(delay_amount):
-                all_durations.append(duration)
-                all_frames.append(all_frames[-1].copy())  # repeat last frame
-        else:
-            if len(all_frames) > 0:
-                # Add delay to last frame of this file
-                all_durations[-1] += delay_between_files
-
-    print(f"Total frames collected: {len(all_frames)}")
-
-    # Save combined APNG
-    if all_frames:
-        all_frames[0].save(
-            output_file,
-            save_all=True,
-            append_images=all_frames[1:],
-            duration=all_durations,  # per-frame durations
-            loop=0,
-            format="PNG"
-        )
+    # Stream all frames from all files into the combined APNG
+    with ApngWriter(output_file, loop=0, delta=True) as writer:
+        last_frame = None
+        last_duration = None
+        for file_path in files_to_combine:
+            duration = 66
+            for frame, duration in animation_cache.frames(file_path):
+                # hold the frame back, the delay after its file may still be added to it
+                if last_frame is not None:
+                    writer.write(last_frame, duration=last_duration)
+                last_frame = frame
+                last_duration = duration
+
+            # Add a random delay after this file
+            delay_between_files = random.randint(min_delay, max_delay)
+            if no_delay_change:
+                # the delay in whole frames: repeats of the last frame, merged into it instead of
+                # written (and compared against the canvas) one by one
+                delay_amount = int(delay_between_files // duration) if last_frame is not None else 0
+                if last_frame is not None:
+                    last_duration += delay_amount * last_duration
+            else:
+                if last_frame is not None:
+                    # Add delay to last frame of this file
+                    last_duration += delay_between_files
+
+        if last_frame is not None:
+            writer.write(last_frame, duration=last_duration)
+
+    # identical consecutive frames are stored once with their durations added up
+    print(f"Total frames stored: {writer.frame_count}")
+    if writer.frame_count:
         print(f"Combined APNG saved to {output_file}")
 
 
@@ -88,6 +139,8 @@ def main():
     #output_file = current_path.joinpath("data", "secrete", "secrete", "intro_animation.png")
     min_delay = 3000  # ms
     max_delay = 10000  # ms
+    # every input file is decoded once for all generated animations
+    animation_cache = DecodedAnimationCache()
     for i in range(2, 3):
         output_file = output_folder.joinpath(f"intro_animation_{str(i).zfill(3)}.png")
         print("Working on:", output_file)
@@ -97,7 +150,8 @@ def main():
             output_file=output_file,
             min_delay=min_delay,
             max_delay=max_delay,
-            no_delay_change=True
+            no_delay_change=True,
+            animation_cache=animation_cache
         )
 
 
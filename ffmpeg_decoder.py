@@ -0,0 +1,193 @@
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from moviepy.config import FFMPEG_BINARY
+from moviepy.video.io.ffmpeg_reader import FFmpegInfosParser, ffmpeg_parse_infos
+
+
+def get_output_size(source_size, resolution=None, rotation=0):
+    """
+    Frame size (width, height) ffmpeg will produce for `resolution`.
+    One side of `resolution` may be -1 to keep the aspect ratio.
+    """
+    width, height = source_size
+    if rotation in (90, 270):
+        width, height = height, width
+    if resolution is None:
+        return width, height
+
+    out_width, out_height = resolution
+    if out_width == -1 and out_height == -1:
+        return width, height
+    if out_width == -1:
+        out_width = max(2, int(round(width * out_height / height / 2)) * 2)
+    elif out_height == -1:
+        out_height = max(2, int(round(height * out_width / width / 2)) * 2)
+    return int(out_width), int(out_height)
+
+
+def check_ranges(ranges):
+    """
+    Raise ValueError unless `ranges` are (start, end) seconds with start >= 0 and end > start
+    (end None = to the end, only for the last range), in order and not overlapping.
+    """
+    previous_end = 0
+    for index, (start, end) in enumerate(ranges):
+        if start < 0:
+            raise ValueError(f"Range {index} {(start, end)} starts before the clip")
+        if end is not None and end <= start:
+            raise ValueError(f"Range {index} {(start, end)} ends before it starts")
+        if previous_end is None or start < previous_end:
+            raise ValueError(f"Range {index} {(start, end)} overlaps the range before it, "
+                             f"ranges must be in order and not overlap")
+        previous_end = end
+
+
+def probe_video(path, input_args=()):
+    """
+    ffmpeg_parse_infos for a source that needs `input_args` before -i (e.g. ["-f", "lavfi"] or a
+    capture device format). -re is left out, the probe only opens the input.
+    """
+    input_args = [arg for arg in input_args if arg != "-re"]
+    if not input_args:
+        return ffmpeg_parse_infos(path)
+    command = [FFMPEG_BINARY, "-hide_banner"] + input_args + ["-i", path]
+    result = subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    infos = result.stderr.decode(errors="ignore")
+    try:
+        return FFmpegInfosParser(infos, path, check_duration=False).parse()
+    except Exception as error:
+        raise IOError(f"ffmpeg could not open {path}: {infos}") from error
+
+
+class FfmpegFrameReader:
+    """
+    Decode a video once, front to back, through an ffmpeg pipe.
+    fps decimation and scaling run inside ffmpeg's filter graph, so no frame is decoded twice
+    and dropped frames never reach Python. Frames are read straight into a small ring of
+    preallocated uint8 RGB buffers: a yielded frame stays valid until `buffer_count - 1`
+    further frames have been read, copy it if you need to keep it longer.
+    `input_args` go before -i, e.g. ["-re"] to read a file at its native frame rate like a live source.
+    `ranges`: optional list of (start, end) seconds (end None = to the end) to decode instead of
+    the whole clip, in order and not overlapping (see check_ranges). Every range is its own input
+    opened with -ss before -i, so ffmpeg seeks to the keyframe before `start` and only decodes from
+    there, and one ffmpeg process concatenates the ranges in order (concat filter), each after its
+    own fps / scale filters.
+    `size` / `fps`: frame size (width, height) and frame rate of the source. The source is probed
+    (with `input_args`) unless `size` is given, pass both for a source that can only be read once
+    (a FIFO, stdin, a capture device), `duration` is None then.
+    """
+
+    def __init__(self, path, fps_out=None, resolution=None, buffer_count=2, input_args=(), ranges=None,
+                 size=None, fps=None):
+        self.path = str(path)
+        self.fps_out = fps_out
+        self.input_args = list(input_args)
+        self.ranges = list(ranges) if ranges else None
+        if self.ranges:
+            check_ranges(self.ranges)
+        if size is None:
+            infos = probe_video(self.path, self.input_args)
+            self.duration = infos.get("duration")
+            self.source_fps = infos["video_fps"]
+            self.size = get_output_size(infos["video_size"], resolution, infos.get("video_rotation", 0))
+        else:
+            self.duration = None
+            self.source_fps = fps
+            self.size = get_output_size(size, resolution)
+        self.resolution = resolution
+        self._buffers = [np.empty((self.size[1], self.size[0], 3), dtype=np.uint8)
+                         for _ in range(max(2, buffer_count))]
+
+    def _filter_graph(self):
+        filters = []
+        if self.fps_out:
+            filters.append(f"fps={self.fps_out}")
+        if self.resolution is not None:
+            filters.append(f"scale={self.size[0]}:{self.size[1]}:flags=area")
+        return ",".join(filters)
+
+    def _inputs(self):
+        if not self.ranges:
+            return self.input_args + ["-i", self.path]
+        inputs = []
+        for start, end in self.ranges:
+            inputs += self.input_args + ["-ss", f"{start:.3f}"]
+            if end is not None:
+                inputs += ["-t", f"{end - start:.3f}"]
+            inputs += ["-i", self.path]
+        return inputs
+
+    def _command(self):
+        command = [FFMPEG_BINARY, "-nostdin", "-loglevel", "error"] + self._inputs()
+        filter_graph = self._filter_graph()
+        if self.ranges and len(self.ranges) > 1:
+            # filter every range on its own so fps decimation restarts at each range's start
+            filter_graph = filter_graph or "null"
+            parts = [f"[{index}:v]{filter_graph}[v{index}]" for index in range(len(self.ranges))]
+            streams = "".join(f"[v{index}]" for index in range(len(self.ranges)))
+            graph = ";".join(parts + [f"{streams}concat=n={len(self.ranges)}:v=1:a=0[out]"])
+            command += ["-filter_complex", graph, "-map", "[out]"]
+        elif filter_graph:
+            command += ["-vf", filter_graph]
+        command += ["-an", "-f", "rawvideo", "-pix_fmt", "rgb24", "-"]
+        return command
+
+    def __iter__(self):
+        process = subprocess.Popen(self._command(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            index = 0
+            while True:
+                buffer = self._buffers[index % len(self._buffers)]
+                view = memoryview(buffer).cast("B")
+                filled = 0
+                while filled < len(view):
+                    read = process.stdout.readinto(view[filled:])
+                    if not read:
+                        break
+                    filled += read
+                if filled == 0:
+                    break
+                if filled < len(view):
+                    raise IOError(f"ffmpeg returned a truncated frame for {self.path}")
+                yield buffer
+                index += 1
+
+            process.wait()
+            if process.returncode != 0:
+                raise IOError(f"ffmpeg failed on {self.path}: {process.stderr.read().decode(errors='replace')}")
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            process.stdout.close()
+            process.stderr.close()
+
+
+def read_frames_at(path, times, resolution=None):
+    """
+    Decode one frame at each of `times` (seconds), every one with its own ffmpeg that seeks
+    with -ss before -i (jump to the nearest keyframe, then decode forward to t). A sparse sample
+    costs a few short decodes instead of a pass over the whole clip. The ffmpeg processes run
+    concurrently, the frames are returned in order as read-only (height, width, 3) uint8 arrays.
+    """
+    path = str(path)
+    infos = ffmpeg_parse_infos(path)
+    width, height = get_output_size(infos["video_size"], resolution, infos.get("video_rotation", 0))
+    scale = ["-vf", f"scale={width}:{height}:flags=area"] if resolution is not None else []
+
+    def read_frame(t):
+        command = ([FFMPEG_BINARY, "-nostdin", "-loglevel", "error", "-ss", f"{t:.3f}", "-i", path,
+                    "-frames:v", "1"] + scale + ["-an", "-f", "rawvideo", "-pix_fmt", "rgb24", "-"])
+        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if result.returncode != 0 or len(result.stdout) < width * height * 3:
+            raise IOError(f"ffmpeg could not read the frame at {t:.3f}s of {path}: "
+                          f"{result.stderr.decode(errors='replace')}")
+        return np.frombuffer(result.stdout, dtype=np.uint8, count=width * height * 3).reshape(height, width, 3)
+
+    times = list(times)
+    if not times:
+        return []
+    with ThreadPoolExecutor(max_workers=min(len(times), os.cpu_count() or 1)) as executor:
+        return list(executor.map(read_frame, times))
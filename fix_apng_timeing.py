@@ -1,5 +1,7 @@
 import pathlib
 from PIL import Image
+from animation_writer import ApngWriter
+from build_manifest import MANIFEST_FILE_NAME, BuildManifest
 
 def add_marker_pixel(img: Image.Image, marker_pixel_01=True) -> Image.Image:
     img = img.copy()
@@ -21,49 +23,36 @@ def update_timeing_in_apng(input_file: pathlib.Path,
 
     im = Image.open(input_file)
 
-    frames = []
-    durations = []
     marker_pixel_first = False
 
-    try:
-        i = 0
-        while i < 600:  # arbitrary large number to prevent infinite loop
-            im.seek(i)
-            frame = im.copy().convert("RGBA")
+    with ApngWriter(output_file, loop=0, delta=True) as writer:
+        try:
+            i = 0
+            while i < 600:  # arbitrary large number to prevent infinite loop
+                im.seek(i)
+                frame = im.copy().convert("RGBA")
 
-            duration_ms = im.info.get("duration", 66)
+                duration_ms = im.info.get("duration", 66)
 
-            frame = add_marker_pixel(frame, marker_pixel_first)
-            marker_pixel_first = not marker_pixel_first
-
-            frames.append(frame)
-            durations.append(66)
-            duration_ms -= 66
-
-            # Split long durations into multiple 100ms frames
-            while duration_ms > 0:
-                frame = make_empty_frame(frame.size)
                 frame = add_marker_pixel(frame, marker_pixel_first)
                 marker_pixel_first = not marker_pixel_first
 
-                # Make a real copy of the frame
-                durations.append(66)
-                frames.append(frame)
+                writer.write(frame, duration=66)
                 duration_ms -= 66
 
-            i += 1
+                # Split long durations into multiple 100ms frames
+                while duration_ms > 0:
+                    frame = make_empty_frame(frame.size)
+                    frame = add_marker_pixel(frame, marker_pixel_first)
+                    marker_pixel_first = not marker_pixel_first
+
+                    writer.write(frame, duration=66)
+                    duration_ms -= 66
 
-    except EOFError:
-        pass
+                i += 1
 
-    frames[0].save(
-        output_file,
-        save_all=True,
-        append_images=frames[1:],
-        duration=durations,  # real durations in ms
-        loop=0,
-        format="PNG",
-    )
+        except EOFError:
+            pass
 
 
 
@@ -71,13 +60,18 @@ def main():
     input_folder = pathlib.Path("data", "apng", "input")
     output_folder = pathlib.Path("data", "apng", "output")
     output_folder.mkdir(parents=True, exist_ok=True)
+    # inputs that are unchanged since their outputs were written are skipped
+    manifest = BuildManifest(output_folder.joinpath(MANIFEST_FILE_NAME))
     for input_file in input_folder.glob("*.png"):
+        if manifest.is_current(str(input_file), [input_file]):
+            continue
         new_file_name = input_file.stem + "_fixed.png"
         output_file = output_folder.joinpath(new_file_name)
         update_timeing_in_apng(
             input_file=input_file,
             output_file=output_file
         )
+        manifest.record(str(input_file), [input_file], outputs=[output_file])
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,90 @@
+import hashlib
+import json
+import os
+import pathlib
+import numpy as np
+from keying_engine import _to_uint8
+
+FRAME_CACHE_FOLDER = pathlib.Path(__file__).parent.joinpath("data", "cache", "frames")
+
+
+def _source_stamp(input_path):
+    stat = os.stat(input_path)
+    return {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+
+
+def _cache_files(input_path, fps_out, resolution, decoder, cache_folder, ranges=None):
+    input_path = pathlib.Path(input_path).resolve()
+    params = {"path": str(input_path),
+              "fps_out": float(fps_out),
+              "resolution": [int(v) for v in resolution] if resolution is not None else None,
+              "decoder": decoder}
+    if ranges:
+        params["ranges"] = [[float(start), None if end is None else float(end)] for start, end in ranges]
+    key = hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+    base = pathlib.Path(cache_folder).joinpath(f"{input_path.stem}_{key}")
+    return base.with_suffix(".frames"), base.with_suffix(".json"), params
+
+
+def open_frame_cache(input_path, fps_out, resolution=None, decoder="ffmpeg", cache_folder=FRAME_CACHE_FOLDER,
+                     ranges=None):
+    """
+    Map the cached frames of `input_path` read-only as a (frames, height, width, 3) uint8 np.memmap.
+    Returns None when there is no cache yet or the video changed (mtime or size) since it was written.
+    """
+    data_file, meta_file, params = _cache_files(input_path, fps_out, resolution, decoder, cache_folder, ranges)
+    if not meta_file.exists() or not data_file.exists():
+        return None
+    with open(meta_file) as fp:
+        meta = json.load(fp)
+    if meta.get("params") != params or meta.get("source") != _source_stamp(input_path):
+        return None
+    return np.memmap(data_file, dtype=np.uint8, mode="r", shape=tuple(meta["shape"]))
+
+
+def write_frame_cache(input_path, frames, fps_out, resolution=None, decoder="ffmpeg",
+                      cache_folder=FRAME_CACHE_FOLDER, ranges=None):
+    """
+    Stream decoded RGB `frames` to the cache file of `input_path` and return them mapped.
+    The metadata is written last, so an interrupted run leaves no cache that looks valid.
+    """
+    data_file, meta_file, params = _cache_files(input_path, fps_out, resolution, decoder, cache_folder, ranges)
+    data_file.parent.mkdir(parents=True, exist_ok=True)
+    source = _source_stamp(input_path)
+    frame_shape = None
+    frame_count = 0
+    temp_file = data_file.with_suffix(".frames.tmp")
+    with open(temp_file, "wb") as fp:
+        for frame in frames:
+            frame = np.ascontiguousarray(_to_uint8(frame))
+            if frame_shape is None:
+                frame_shape = frame.shape
+            elif frame.shape != frame_shape:
+                raise ValueError(f"Frame size changed from {frame_shape} to {frame.shape} in {input_path}")
+            fp.write(memoryview(frame).cast("B"))
+            frame_count += 1
+    if frame_count == 0:
+        temp_file.unlink()
+        raise ValueError(f"No frames decoded from {input_path}")
+    temp_file.replace(data_file)
+
+    meta = {"params": params, "source": source, "shape": [frame_count, *frame_shape]}
+    temp_meta = meta_file.with_suffix(".json.tmp")
+    with open(temp_meta, "w") as fp:
+        json.dump(meta, fp, indent=2)
+    temp_meta.replace(meta_file)
+    return open_frame_cache(input_path, fps_out, resolution, decoder, cache_folder, ranges)
+
+
+def cached_frames(input_path, decode, fps_out, resolution=None, decoder="ffmpeg", cache_folder=FRAME_CACHE_FOLDER,
+                  ranges=None):
+    """
+    Decoded frames of `input_path` for (fps_out, resolution, decoder, time ranges) as a read-only np.memmap.
+    `decode()` is only called (and its frames written to the cache) when there is no valid cache,
+    later runs key straight from the mapped pages. The cache takes
+    frames * height * width * 3 bytes of disk, delete `cache_folder` to reclaim it.
+    """
+    frames = open_frame_cache(input_path, fps_out, resolution, decoder, cache_folder, ranges)
+    if frames is None:
+        frames = write_frame_cache(input_path, decode(), fps_out, resolution, decoder, cache_folder, ranges)
+    return frames
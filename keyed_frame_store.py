@@ -0,0 +1,146 @@
+import json
+import os
+import pathlib
+import shutil
+import zlib
+import numpy as np
+from frame_cache import _source_stamp
+
+INDEX_FILE_NAME = "index.json"
+FRAMES_FILE_NAME = "frames.bin"
+
+
+def encode_frame(rgba, level=1) -> bytes:
+    """
+    zlib-compressed bytes of an RGBA frame (keyed frames are mostly transparent zeros and
+    compress well even at the fastest level).
+    """
+    return zlib.compress(memoryview(np.ascontiguousarray(rgba, dtype=np.uint8)).cast("B"), level)
+
+
+def decode_frame(data, shape):
+    """
+    Frame of `shape` back from encode_frame bytes, as a new writable uint8 array.
+    """
+    return np.frombuffer(bytearray(zlib.decompress(data)), dtype=np.uint8).reshape(shape)
+
+
+class KeyedFrameStore:
+    """
+    Checkpoint of a keying run in `folder`: the keyed RGBA frames compressed one at a time (see
+    encode_frame) and appended to frames.bin, plus an index.json with the frame shape and the
+    (offset, length) of every frame safely on disk. The index is advanced every `sync_frames`
+    frames once the frame file is synced, so after a crash the store holds every frame up to the
+    last sync (a torn tail is cut off) and at most `sync_frames` frames have to be keyed again.
+    Only the frame being written or read is in memory.
+    The store belongs to one input file and one set of keying `params`: opening it for a
+    changed input or different params starts it over.
+    """
+
+    def __init__(self, folder, input_path, params, sync_frames=16):
+        self.folder = pathlib.Path(folder)
+        self.sync_frames = sync_frames
+        self._index_file = self.folder.joinpath(INDEX_FILE_NAME)
+        self._frames_file = self.folder.joinpath(FRAMES_FILE_NAME)
+        self._fp = None
+        self._pending = []
+        params = json.loads(json.dumps(params, sort_keys=True, default=str))
+        source = _source_stamp(input_path)
+        index = None
+        if self._index_file.exists():
+            with open(self._index_file) as fp:
+                index = json.load(fp)
+        if (index is None or index.get("params") != params or index.get("source") != source
+                or not isinstance(index.get("frames"), list)):
+            if self.folder.exists():
+                shutil.rmtree(self.folder)
+            index = {"params": params, "source": source, "frame_shape": None, "frames": []}
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self._index = index
+        # frames written after the last index update are incomplete or unaccounted for
+        self._end = sum(index["frames"][-1]) if index["frames"] else 0
+        with open(self._frames_file, "ab") as fp:
+            fp.truncate(self._end)
+
+    @property
+    def frame_count(self) -> int:
+        """
+        Number of frames safely on disk.
+        """
+        return len(self._index["frames"])
+
+    def _write_index(self):
+        temp_file = self._index_file.with_suffix(".json.tmp")
+        with open(temp_file, "w") as fp:
+            json.dump(self._index, fp)
+        temp_file.replace(self._index_file)
+
+    def flush(self):
+        """
+        Sync the appended frames to disk and add them to the index.
+        """
+        if not self._pending:
+            return
+        self._fp.flush()
+        os.fsync(self._fp.fileno())
+        self._index["frames"] += self._pending
+        self._write_index()
+        self._pending = []
+
+    def append(self, rgba):
+        if self._index["frame_shape"] is None:
+            self._index["frame_shape"] = list(rgba.shape)
+        elif list(rgba.shape) != self._index["frame_shape"]:
+            raise ValueError(f"Frame of shape {rgba.shape} in a store of {tuple(self._index['frame_shape'])} frames")
+        if self._fp is None:
+            self._fp = open(self._frames_file, "ab")
+        data = encode_frame(rgba)
+        self._fp.write(data)
+        self._pending.append([self._end, len(data)])
+        self._end += len(data)
+        if len(self._pending) >= self.sync_frames:
+            self.flush()
+
+    def close(self):
+        """
+        Flush the appended frames and close the frame file.
+        """
+        if self._fp is not None:
+            self.flush()
+            self._fp.close()
+            self._fp = None
+
+    def iter_stored(self):
+        """
+        Yield the stored frames in order, every one read and decompressed on its own into a new array.
+        """
+        if not self.frame_count:
+            return
+        shape = self._index["frame_shape"]
+        with open(self._frames_file, "rb") as fp:
+            for offset, length in self._index["frames"]:
+                fp.seek(offset)
+                data = fp.read(length)
+                if len(data) != length:
+                    raise IOError(f"Truncated checkpoint {self._frames_file}")
+                yield decode_frame(data, shape)
+
+    def resume(self, keyed_frames):
+        """
+        Yield every stored frame, then the frames of `keyed_frames` (which should start at frame
+        `frame_count`) while appending them to the store. The appended frames are synced when
+        `keyed_frames` is exhausted or the generator is closed.
+        """
+        yield from self.iter_stored()
+        try:
+            for rgba in keyed_frames:
+                self.append(rgba)
+                yield rgba
+        finally:
+            self.close()
+
+    def remove(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+        shutil.rmtree(self.folder, ignore_errors=True)
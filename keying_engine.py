@@ -0,0 +1,875 @@
+import hashlib
+import json
+import os
+import pathlib
+import queue
+import tempfile
+import threading
+import time
+import numpy as np
+import cv2
+from PIL import Image
+
+LUT_CACHE_FOLDER = pathlib.Path(__file__).parent.joinpath("data", "cache", "keying_lut")
+LUT_FORMAT = 2
+
+
+def _to_uint8(frame):
+    arr = np.asarray(frame)
+    if arr.dtype == np.uint8:
+        return arr
+    if np.issubdtype(arr.dtype, np.floating):
+        # MoviePy sometimes returns floats in 0..1 or 0..255
+        if arr.max() <= 1.1:
+            arr = (arr * 255.0).clip(0, 255)
+        else:
+            arr = arr.clip(0, 255)
+    return arr.astype(np.uint8)
+
+
+def apply_mask(frame, lower=(37, 40, 40), upper=(85, 255, 255)):
+    """
+    Remove green background using HSV thresholding.
+    Returns an RGBA image where alpha is a binary-ish mask (0 or 255).
+    """
+    frame_u8 = _to_uint8(frame)
+    hsv = cv2.cvtColor(frame_u8, cv2.COLOR_RGB2HSV)
+
+    # Mask for green (green -> 255)
+    mask_green = cv2.inRange(hsv, np.array(lower), np.array(upper))
+
+    # Foreground mask: non-green -> 255
+    fg_mask = cv2.bitwise_not(mask_green)
+
+    # Optional: small morphological opening to clean tiny spots
+    kernel3 = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
+    fg_mask = cv2.morphologyEx(fg_mask, cv2.MORPH_OPEN, kernel3, iterations=1)
+
+    # Return RGBA with alpha = fg_mask (0/255)
+    rgba = np.dstack((frame_u8, fg_mask))
+    return rgba
+
+
+def expand_transparency(rgba, shrink_pixels=0, feather=5, alpha_thresh=1):
+    """
+    Expand the transparent area by `shrink_pixels`:
+      - erode the binary foreground mask `shrink_pixels` times (3x3 ellipse kernel)
+      - blur (feather) the eroded mask to make smooth edges
+      - premultiply RGB by the resulting alpha to avoid green fringing
+    Parameters:
+      shrink_pixels: int, number of pixels to remove from object edge (>=0)
+      feather: int, radius for gaussian blur (>=0). Final kernel = 2*feather+1 (odd).
+      alpha_thresh: pixels with alpha <= this are considered fully transparent (used only if needed)
+    """
+    # Separate
+    rgb = rgba[:, :, :3].astype(np.uint8)
+    alpha = rgba[:, :, 3].astype(np.uint8)
+
+    # Ensure binary mask (0 or 255) from alpha
+    bin_mask = (alpha > alpha_thresh).astype(np.uint8) * 255
+
+    if shrink_pixels > 0:
+        # Use a small ellipse kernel and perform `shrink_pixels` iterations
+        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
+        eroded = cv2.erode(bin_mask, kernel, iterations=shrink_pixels)
+    else:
+        eroded = bin_mask
+
+    # Feather / smooth the alpha (make sure kernel is odd and >=1)
+    if feather and feather > 0:
+        k = max(1, int(feather) * 2 + 1)
+        eroded_blurred = cv2.GaussianBlur(eroded, (k, k), 0)
+    else:
+        eroded_blurred = eroded
+
+    # Make sure alpha is 0..255 uint8
+    new_alpha = np.clip(eroded_blurred, 0, 255).astype(np.uint8)
+
+    # Premultiply RGB by alpha to avoid leftover green fringes at semi-transparent edges
+    # alpha_scale shape (H, W, 1)
+    alpha_scale = (new_alpha.astype(np.float32) / 255.0)[:, :, None]
+    premult_rgb = (rgb.astype(np.float32) * alpha_scale).round().astype(np.uint8)
+
+    out_rgba = np.dstack((premult_rgb, new_alpha))
+    return out_rgba
+
+
+def rgba_to_gif_frame(rgba_frame: Image.Image, alpha_cutoff=128):
+    """
+    Convert an RGBA image to a GIF frame (P-mode) with transparency,
+    without introducing a fake magenta marker color.
+    """
+    rgba = rgba_frame.convert("RGBA")
+    arr = np.array(rgba)
+
+    # Binary mask: alpha below cutoff → transparent
+    alpha = arr[:, :, 3]
+    mask_transparent = alpha <= alpha_cutoff
+
+    # Fill transparent areas with black (or any safe color)
+    arr_rgb = arr[:, :, :3].copy()
+    arr_rgb[mask_transparent] = (0, 0, 0)
+
+    # Convert back to image
+    tmp = Image.fromarray(arr_rgb, mode="RGB")
+
+    # Quantize to P mode (max 255 colors for GIF + 1 reserved for transparency)
+    pal = tmp.convert("P", palette="ADAPTIVE", colors=255)
+
+    # Find closest color to our fill color (0,0,0 here)
+    palette = pal.getpalette()
+    if palette is None:
+        palette = []
+    palette = palette + [0] * (768 - len(palette))
+
+    # Look for black in palette
+    marker_index = None
+    for i in range(256):
+        r, g, b = palette[3 * i:3 * i + 3]
+        if (r, g, b) == (0, 0, 0):
+            marker_index = i
+            break
+    if marker_index is None:
+        marker_index = 0
+
+    # Apply transparency where alpha was low
+    pal.info["transparency"] = marker_index
+    pal.info["disposal"] = 2
+
+    return pal
+
+
+def key_frames(frames, keyer):
+    """
+    Key decoded RGB frames one at a time with a ChromaKeyer.
+    Yields RGBA numpy arrays, nothing is kept around after a frame is consumed.
+    The yielded array is the keyer's reused output buffer, copy it to keep it past the next frame.
+    """
+    for frame in frames:
+        yield keyer.key(frame)
+
+
+def save_frames(frames, writers=()) -> int:
+    """
+    Fan keyed RGBA frames out to `writers` (objects with a write(image, offset=...) method).
+    `frames` yields RGBA arrays or (rgba, offset) pairs for frames cropped out of a larger canvas.
+    Keyers reuse their output buffers, so when a writer keeps frames past its write() call
+    (`keeps_frames`, e.g. a ThreadedWriter) every frame is copied once here and shared read-only
+    by all writers.
+    Returns the number of frames written.
+    """
+    copy_frames = any(getattr(writer, "keeps_frames", False) for writer in writers)
+    frame_count = 0
+    for item in frames:
+        rgba, offset = item if isinstance(item, tuple) else (item, (0, 0))
+        image_item = Image.fromarray(rgba.copy() if copy_frames else rgba)
+        for writer in writers:
+            writer.write(image_item, offset=offset)
+        frame_count += 1
+
+    return frame_count
+
+
+class FrameRing:
+    """
+    Fixed set of reusable numpy frame buffers. acquire() blocks until a slot is free, so the ring
+    also bounds how far a producer can run ahead. A slot's buffer is (re)allocated on first use
+    or when the frame shape changes.
+    """
+
+    def __init__(self, size):
+        self.buffers = [None] * size
+        self._free = queue.Queue()
+        for slot in range(size):
+            self._free.put(slot)
+
+    def acquire(self, stop=None) -> int:
+        """
+        Index of a free slot, or None once `stop` (a threading.Event) is set.
+        """
+        while True:
+            try:
+                return self._free.get(timeout=0.1)
+            except queue.Empty:
+                if stop is not None and stop.is_set():
+                    return None
+
+    def buffer(self, slot, shape):
+        if self.buffers[slot] is None or self.buffers[slot].shape != shape:
+            self.buffers[slot] = np.empty(shape, dtype=np.uint8)
+        return self.buffers[slot]
+
+    def release(self, slot):
+        self._free.put(slot)
+
+
+def _put(target_queue, item, stop):
+    # blocking put that gives up once the pipeline is stopped
+    while not stop.is_set():
+        try:
+            target_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def key_frames_pipelined(frames, make_keyer, key_threads=None, decode_queue_size=4, output_queue_size=8):
+    """
+    Threaded version of key_frames: a decoder thread pulls `frames` into a ring of
+    `decode_queue_size` reusable buffers, `key_threads` threads (None uses all cores) key them,
+    each with its own keyer from `make_keyer()` because keyers are not thread safe, into a ring of
+    `output_queue_size` buffers, and the frames are yielded here in their original order.
+    OpenCV and the decoder release the GIL, so decoding, keying and whatever the caller does with
+    the yielded frames (e.g. writing) overlap in one process.
+    An output slot is reserved in frame order before a frame is decoded, so a slow frame can't
+    be starved of a slot by the frames after it. The yielded array is reused once the next frame
+    is requested, copy it to keep it. An error in any stage is raised here.
+    """
+    key_threads = key_threads or os.cpu_count() or 1
+    decode_ring = FrameRing(decode_queue_size)
+    output_ring = FrameRing(max(output_queue_size, key_threads + 1))
+    tasks = queue.Queue(maxsize=decode_queue_size)
+    results = queue.Queue()
+    stop = threading.Event()
+
+    def decode():
+        try:
+            for index, frame in enumerate(frames):
+                output_slot = output_ring.acquire(stop)
+                input_slot = decode_ring.acquire(stop) if output_slot is not None else None
+                if input_slot is None:
+                    return
+                frame = _to_uint8(frame)
+                np.copyto(decode_ring.buffer(input_slot, frame.shape), frame)
+                if not _put(tasks, (index, input_slot, output_slot), stop):
+                    return
+        except Exception as error:
+            results.put(("error", error))
+        finally:
+            for _ in range(key_threads):
+                _put(tasks, None, stop)
+
+    def key():
+        try:
+            keyer = make_keyer()
+            while not stop.is_set():
+                try:
+                    task = tasks.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if task is None:
+                    break
+                index, input_slot, output_slot = task
+                rgba = keyer.key(decode_ring.buffers[input_slot])
+                np.copyto(output_ring.buffer(output_slot, rgba.shape), rgba)
+                decode_ring.release(input_slot)
+                results.put(("frame", (index, output_slot)))
+        except Exception as error:
+            results.put(("error", error))
+        finally:
+            results.put(("done", None))
+
+    threads = [threading.Thread(target=decode, name="key-pipeline-decode", daemon=True)]
+    threads += [threading.Thread(target=key, name=f"key-pipeline-key-{number}", daemon=True)
+                for number in range(key_threads)]
+    for thread in threads:
+        thread.start()
+
+    ready = {}
+    next_index = 0
+    running = key_threads
+    try:
+        while running or next_index in ready:
+            if next_index in ready:
+                output_slot = ready.pop(next_index)
+                yield output_ring.buffers[output_slot]
+                output_ring.release(output_slot)
+                next_index += 1
+                continue
+            kind, value = results.get()
+            if kind == "error":
+                raise value
+            if kind == "done":
+                running -= 1
+            else:
+                ready[value[0]] = value[1]
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+
+def _hsv_outside_distance(hsv, lower, upper):
+    """
+    Per pixel distance (in OpenCV HSV units) of `hsv` to the box lower..upper, 0 inside the box.
+    Hue (0..179) wraps around.
+    """
+    hsv = hsv.astype(np.int32)
+    lower = np.array(lower, dtype=np.int32)
+    upper = np.array(upper, dtype=np.int32)
+    below = np.maximum(lower - hsv, 0)
+    above = np.maximum(hsv - upper, 0)
+    # the short way round may be across 0/180 to the opposite bound
+    hue = hsv[..., 0]
+    hue_below = np.minimum(below[..., 0], hue + 180 - upper[0])
+    hue_above = np.minimum(above[..., 0], lower[0] + 180 - hue)
+    hue_distance = np.where(below[..., 0] > 0, hue_below, hue_above)
+    return np.maximum(hue_distance, np.maximum(below[..., 1:], above[..., 1:]).max(axis=-1))
+
+
+def build_alpha_lut(lower, upper, softness=0, bits=6):
+    """
+    Build a (2**bits)^3 RGB -> alpha cube from the HSV thresholds.
+    Every cell is keyed with the color at its center: inside lower..upper -> 0, otherwise 255.
+    With softness > 0 alpha ramps from 0 to 255 over `softness` HSV units outside the range
+    instead of jumping.
+    """
+    levels = 2 ** bits
+    step = 256 // levels
+    centers = (np.arange(levels) * step + step // 2).astype(np.uint8)
+    r, g, b = np.meshgrid(centers, centers, centers, indexing="ij")
+    rgb = np.stack((r, g, b), axis=-1).reshape(levels * levels, levels, 3)
+    hsv = cv2.cvtColor(rgb, cv2.COLOR_RGB2HSV)
+
+    if softness and softness > 0:
+        distance = _hsv_outside_distance(hsv, lower, upper)
+        alpha = np.clip(distance * 255.0 / softness, 0, 255).round().astype(np.uint8)
+    else:
+        alpha = cv2.bitwise_not(cv2.inRange(hsv, np.array(lower), np.array(upper)))
+    return alpha.reshape(levels, levels, levels)
+
+
+def load_alpha_lut(lower, upper, softness=0, bits=6, cache_folder=LUT_CACHE_FOLDER):
+    """
+    build_alpha_lut with an on-disk cache keyed by the parameters, so batch runs build a cube once.
+    """
+    params = {"lower": [int(v) for v in lower],
+              "upper": [int(v) for v in upper],
+              "softness": float(softness or 0),
+              "bits": int(bits)}
+    if cache_folder is None:
+        return build_alpha_lut(**params)
+
+    # bump LUT_FORMAT when build_alpha_lut changes, cubes cached by older code are not reused
+    key = hashlib.sha1(json.dumps(dict(params, format=LUT_FORMAT), sort_keys=True).encode()).hexdigest()[:16]
+    cache_file = pathlib.Path(cache_folder).joinpath(f"lut_{key}.npy")
+    if cache_file.exists():
+        return np.load(cache_file)
+
+    lut = build_alpha_lut(**params)
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    # a temp file of our own: concurrent batch workers may build the same cube at once
+    with tempfile.NamedTemporaryFile(dir=cache_file.parent, prefix=cache_file.stem, suffix=".tmp",
+                                     delete=False) as fp:
+        try:
+            np.save(fp, lut)
+        except BaseException:
+            fp.close()
+            os.unlink(fp.name)
+            raise
+    os.replace(fp.name, cache_file)
+    return lut
+
+
+def packed_rgb_lut(lut):
+    """
+    Spread a compact cube over the index space of a packed RGBA uint32 pixel, so one
+    `(pixel & mask) >> shift` gives the table index directly (works for either byte order).
+    Returns (table, mask, shift).
+    """
+    levels = lut.shape[0]
+    bits = levels.bit_length() - 1
+    shift = 8 - bits
+    channel_mask = (0xFF << shift) & 0xFF
+    mask = int(np.array([channel_mask, channel_mask, channel_mask, 0], dtype=np.uint8).view(np.uint32)[0])
+
+    cells = np.arange(levels, dtype=np.uint8) << shift
+    r, g, b = np.meshgrid(cells, cells, cells, indexing="ij")
+    rgba = np.stack((r, g, b, np.zeros_like(r)), axis=-1)
+    index = rgba.view(np.uint32)[..., 0] >> shift
+
+    table = np.zeros(int(mask >> shift) + 1, dtype=np.uint8)
+    table[index.ravel()] = lut.ravel()
+    return table, np.intp(mask), np.intp(shift)
+
+
+class ChromaKeyer:
+    """
+    Green screen keyer producing the same result as apply_mask + expand_transparency,
+    but with all working buffers allocated once per frame size and every step writing
+    into them in place (OpenCV dst= arguments). The premultiply is done by cv2.multiply
+    on uint8 data with rounding, no float32 frame copies are made.
+
+    key_mode:
+      "hsv": cv2.cvtColor to HSV + cv2.inRange on every frame
+      "lut": one table lookup per pixel in a quantized RGB -> alpha cube built from the same
+             thresholds (see build_alpha_lut), `lut_bits` per channel, cached in `lut_cache_folder`.
+             `softness` > 0 gives a soft alpha ramp outside the thresholds, that ramp is kept
+             instead of being binarized before the edge refinement.
+
+    edge_mode:
+      "morph":    erode `shrink_pixels` times with a 3x3 ellipse, then a (2*feather+1)^2 Gaussian blur,
+                  the cost grows with both radii
+      "distance": one signed distance transform of the foreground mask gives the shrink and a
+                  linear alpha ramp 2*feather pixels wide centered on the new edge, the cost is the
+                  same for any radius (a soft lut alpha is binarized first)
+
+    key() returns the keyer's own RGBA output buffer, which is overwritten by the next call.
+    Copy it if you need to keep it.
+    """
+
+    def __init__(self,
+                 lower=(37, 40, 40),
+                 upper=(85, 255, 255),
+                 shrink_pixels=0,
+                 feather=5,
+                 alpha_thresh=1,
+                 key_mode="hsv",
+                 softness=0,
+                 lut_bits=6,
+                 lut_cache_folder=LUT_CACHE_FOLDER,
+                 edge_mode="morph"):
+        if key_mode not in ("hsv", "lut"):
+            raise ValueError(f"Unknown key_mode: {key_mode}")
+        if edge_mode not in ("morph", "distance"):
+            raise ValueError(f"Unknown edge_mode: {edge_mode}")
+        self.lower = np.array(lower, dtype=np.uint8)
+        self.upper = np.array(upper, dtype=np.uint8)
+        self.shrink_pixels = int(shrink_pixels)
+        self.feather = int(feather) if feather else 0
+        self.alpha_thresh = alpha_thresh
+        self.key_mode = key_mode
+        self.softness = softness if key_mode == "lut" else 0
+        self.edge_mode = edge_mode
+        self.kernel3 = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
+        self.blur_size = (self.feather * 2 + 1, self.feather * 2 + 1)
+        self._shape = None
+        if key_mode == "lut":
+            lut = load_alpha_lut(lower, upper, softness=softness, bits=lut_bits, cache_folder=lut_cache_folder)
+            self._lut_table, self._lut_mask, self._lut_shift = packed_rgb_lut(lut)
+
+    @property
+    def refine_edges(self):
+        return self.shrink_pixels > 0 or self.feather > 0
+
+    def _allocate(self, height, width):
+        self._shape = (height, width)
+        self._hsv = np.empty((height, width, 3), dtype=np.uint8)
+        self._mask = np.empty((height, width), dtype=np.uint8)
+        self._alpha = np.empty((height, width), dtype=np.uint8)
+        self._alpha4 = np.empty((height, width, 4), dtype=np.uint8)
+        self._out = np.empty((height, width, 4), dtype=np.uint8)
+        if self.key_mode == "lut":
+            self._index = np.empty((height, width), dtype=np.intp)
+        if self.edge_mode == "distance":
+            self._dist_in = np.empty((height, width), dtype=np.float32)
+            self._dist_out = np.empty((height, width), dtype=np.float32)
+
+    def key(self, frame):
+        return self._compose(self.key_alpha(frame))
+
+    def key_alpha(self, frame):
+        """
+        Compute only the final alpha of `frame` (a reused buffer). Also leaves the RGBA version
+        of `frame` in the output buffer, ready for _compose.
+        """
+        alpha = self._mask_alpha(frame)
+        if not self.refine_edges:
+            return alpha
+        return self._refine_alpha(alpha)
+
+    def _mask_alpha(self, frame):
+        """
+        Foreground mask of `frame` (color test + opening), before any edge refinement.
+        """
+        frame = _to_uint8(frame)
+        if frame.shape[:2] != self._shape:
+            self._allocate(*frame.shape[:2])
+
+        cv2.cvtColor(frame, cv2.COLOR_RGB2RGBA, dst=self._out)
+        if self.key_mode == "lut":
+            # packed RGBA pixel -> cube index -> foreground alpha
+            np.bitwise_and(self._out.view(np.uint32)[..., 0], self._lut_mask, out=self._index)
+            np.right_shift(self._index, self._lut_shift, out=self._index)
+            np.take(self._lut_table, self._index, out=self._mask, mode="clip")
+        else:
+            # green -> 255, then invert to get the foreground mask
+            cv2.cvtColor(frame, cv2.COLOR_RGB2HSV, dst=self._hsv)
+            cv2.inRange(self._hsv, self.lower, self.upper, dst=self._mask)
+            cv2.bitwise_not(self._mask, dst=self._mask)
+        # clean tiny spots
+        cv2.morphologyEx(self._mask, cv2.MORPH_OPEN, self.kernel3, dst=self._alpha, iterations=1)
+        return self._alpha
+
+    def _compose(self, alpha):
+        """
+        Put `alpha` into the RGBA output buffer, premultiplying RGB when the edges were refined.
+        """
+        if not self.refine_edges:
+            cv2.mixChannels([alpha], [self._out], [0, 3])
+            return self._out
+
+        # premultiply: out (alpha channel = 255) * (a, a, a, a) / 255 -> (r*a, g*a, b*a, a) / 255
+        cv2.merge((alpha, alpha, alpha, alpha), dst=self._alpha4)
+        cv2.multiply(self._out, self._alpha4, dst=self._out, scale=1.0 / 255.0)
+        return self._out
+
+    def _refine_alpha(self, alpha):
+        """
+        Erode and feather the foreground mask in place, see expand_transparency.
+        """
+        if self.edge_mode == "distance":
+            return self._refine_alpha_distance(alpha)
+        if not self.softness:
+            cv2.threshold(alpha, self.alpha_thresh, 255, cv2.THRESH_BINARY, dst=alpha)
+        if self.shrink_pixels > 0:
+            cv2.erode(alpha, self.kernel3, dst=self._mask, iterations=self.shrink_pixels)
+            alpha, self._mask = self._mask, alpha
+        if self.feather > 0:
+            cv2.GaussianBlur(alpha, self.blur_size, 0, dst=self._mask)
+            alpha, self._mask = self._mask, alpha
+        self._alpha = alpha
+        return alpha
+
+    def _refine_alpha_distance(self, alpha):
+        """
+        Signed distance to the mask edge: dist_in (foreground pixels to the nearest background
+        pixel) - dist_out (background pixels to the nearest foreground pixel). The new edge lies
+        `shrink_pixels` inside the old one and alpha ramps linearly across it:
+          alpha = 255 * clip(0.5 + (dist_in - dist_out - edge) / ramp, 0, 1)
+        which cv2.addWeighted evaluates and saturates to uint8 in a single pass.
+        """
+        cv2.threshold(alpha, self.alpha_thresh, 255, cv2.THRESH_BINARY, dst=alpha)
+        cv2.distanceTransform(alpha, cv2.DIST_L2, 5, dst=self._dist_in)
+        cv2.bitwise_not(alpha, dst=self._mask)
+        cv2.distanceTransform(self._mask, cv2.DIST_L2, 5, dst=self._dist_out)
+
+        edge = self.shrink_pixels + 0.5
+        ramp = max(2.0 * self.feather, 1.0)
+        scale = 255.0 / ramp
+        cv2.addWeighted(self._dist_in, scale, self._dist_out, -scale, 255.0 * (0.5 - edge / ramp),
+                        dst=alpha, dtype=cv2.CV_8U)
+        return alpha
+
+
+class TemporalChromaKeyer(ChromaKeyer):
+    """
+    ChromaKeyer for locked-off footage that only re-keys the parts of a frame that changed.
+
+    Every frame is compared in `tile_size` tiles with the pixels the cached alpha was computed
+    from. Tiles whose largest channel difference is above `change_threshold` are re-keyed
+    (with enough surrounding context for the opening, shrink and feather to come out the same
+    as a full key), all other tiles reuse the cached alpha. A full key runs on the first frame,
+    every `refresh_interval` frames, and whenever more than `full_key_ratio` of the tiles changed.
+    Takes the same keying arguments as ChromaKeyer.
+    """
+
+    def __init__(self,
+                 tile_size=32,
+                 change_threshold=12,
+                 refresh_interval=30,
+                 full_key_ratio=0.5,
+                 **keyer_args):
+        super().__init__(**keyer_args)
+        self.tile_size = int(tile_size)
+        self.change_threshold = change_threshold
+        self.refresh_interval = refresh_interval
+        self.full_key_ratio = full_key_ratio
+        # region re-keying reallocates per region size, keep that away from the full frame buffers
+        self._region_keyer = ChromaKeyer(**keyer_args)
+        # pixels around a changed tile whose alpha can change: opening (2) + shrink + feather / ramp
+        self.margin = 2 + self.shrink_pixels + 2 * self.feather + 1
+        self.frame_index = 0
+        self.rekeyed_tiles = 0
+        self.total_tiles = 0
+
+    def _allocate(self, height, width):
+        super()._allocate(height, width)
+        tile = self.tile_size
+        self._tiles_y = -(-height // tile)
+        self._tiles_x = -(-width // tile)
+        self._reference = np.empty((height, width, 3), dtype=np.uint8)
+        self._alpha_cache = np.empty((height, width), dtype=np.uint8)
+        # padded to whole tiles, the padding stays 0 so it never counts as a change
+        self._diff = np.zeros((self._tiles_y * tile, self._tiles_x * tile, 3), dtype=np.uint8)
+        self._last_refresh = None
+
+    def key(self, frame):
+        frame = _to_uint8(frame)
+        if frame.shape[:2] != self._shape:
+            self._allocate(*frame.shape[:2])
+        height, width = self._shape
+        tile = self.tile_size
+        tile_count = self._tiles_y * self._tiles_x
+        self.total_tiles += tile_count
+
+        needs_refresh = (self._last_refresh is None
+                         or self.frame_index - self._last_refresh >= self.refresh_interval)
+        changed = None
+        if not needs_refresh:
+            cv2.absdiff(frame, self._reference, dst=self._diff[:height, :width])
+            tile_max = self._diff.reshape(self._tiles_y, tile, self._tiles_x, tile * 3).max(axis=(1, 3))
+            changed = (tile_max > self.change_threshold).astype(np.uint8)
+            needs_refresh = changed.sum() > self.full_key_ratio * tile_count
+
+        if needs_refresh:
+            alpha = self.key_alpha(frame)
+            np.copyto(self._alpha_cache, alpha)
+            np.copyto(self._reference, frame)
+            self._last_refresh = self.frame_index
+            self.rekeyed_tiles += tile_count
+        else:
+            cv2.cvtColor(frame, cv2.COLOR_RGB2RGBA, dst=self._out)
+            self._rekey_changed_tiles(frame, changed)
+
+        self.frame_index += 1
+        return self._compose(self._alpha_cache)
+
+    def _rekey_changed_tiles(self, frame, changed):
+        height, width = self._shape
+        tile = self.tile_size
+        margin_tiles = -(-self.margin // tile)
+        # every tile within the margin of a changed pixel needs new alpha
+        dirty = cv2.dilate(changed, np.ones((2 * margin_tiles + 1, 2 * margin_tiles + 1), np.uint8))
+        count, _, stats, _ = cv2.connectedComponentsWithStats(dirty, connectivity=8)
+        for x, y, w, h, _ in stats[1:count]:
+            self.rekeyed_tiles += w * h
+            # region to write back and the larger region keyed around it for context
+            x0, y0 = x * tile, y * tile
+            x1, y1 = min((x + w) * tile, width), min((y + h) * tile, height)
+            cx0, cy0 = max(x0 - self.margin, 0), max(y0 - self.margin, 0)
+            cx1, cy1 = min(x1 + self.margin, width), min(y1 + self.margin, height)
+
+            region_alpha = self._region_keyer.key_alpha(frame[cy0:cy1, cx0:cx1])
+            self._alpha_cache[y0:y1, x0:x1] = region_alpha[y0 - cy0:y1 - cy0, x0 - cx0:x1 - cx0]
+            self._reference[y0:y1, x0:x1] = frame[y0:y1, x0:x1]
+
+
+class NumpyChromaKeyer(ChromaKeyer):
+    """
+    Pure NumPy version of the "hsv" / "morph" ChromaKeyer pipeline (OpenCV is only used for
+    what the base class sets up). The HSV conversion, opening, erosion and Gaussian feather are
+    written out with array operations following OpenCV's 8-bit conventions (fixed point HSV, the
+    same Gaussian kernel), results agree with ChromaKeyer up to rounding of the feathered edge.
+    The work is split into ChromaKeyer's stage methods, so instrument_keyer times it the same way.
+    Returns a new RGBA array for every frame.
+    """
+
+    def __init__(self, **keyer_args):
+        super().__init__(**keyer_args)
+        if self.key_mode != "hsv" or self.edge_mode != "morph":
+            raise ValueError("The numpy keying backend only supports key_mode='hsv' and edge_mode='morph'")
+        # OpenCV's own kernel: sizes up to 7 use fixed tables, not the sigma formula
+        self._blur_kernel = cv2.getGaussianKernel(self.blur_size[0], 0).ravel().astype(np.float32)
+
+    # OpenCV's 8-bit RGB -> HSV works in fixed point with these division tables (hsv_shift = 12)
+    _HSV_SHIFT = 12
+    _divisors = np.maximum(np.arange(256, dtype=np.float64), 1)
+    _SDIV_TABLE = np.where(np.arange(256) == 0, 0, np.rint((255 << 12) / _divisors)).astype(np.int64)
+    _HDIV_TABLE = np.where(np.arange(256) == 0, 0, np.rint((180 << 12) / (6 * _divisors))).astype(np.int64)
+
+    @classmethod
+    def _rgb_to_hsv(cls, frame):
+        rgb = frame.astype(np.int64)
+        r, g, b = rgb[:, :, 0], rgb[:, :, 1], rgb[:, :, 2]
+        value = rgb.max(axis=2)
+        delta = value - rgb.min(axis=2)
+        half = 1 << (cls._HSV_SHIFT - 1)
+        saturation = (delta * cls._SDIV_TABLE[value] + half) >> cls._HSV_SHIFT
+        hue = np.where(value == r, g - b, np.where(value == g, b - r + 2 * delta, r - g + 4 * delta))
+        hue = (hue * cls._HDIV_TABLE[delta] + half) >> cls._HSV_SHIFT
+        hue = np.where(hue < 0, hue + 180, hue)
+        return np.stack((hue, saturation, value), axis=-1).astype(np.uint8)
+
+    @staticmethod
+    def _cross_filter(mask, reduce, border):
+        # 3x3 ellipse == cross, outside pixels count as `border` (OpenCV's default for erode / dilate)
+        padded = np.pad(mask, 1, mode="constant", constant_values=border)
+        result = reduce(padded[1:-1, 1:-1], padded[:-2, 1:-1])
+        result = reduce(result, padded[2:, 1:-1])
+        result = reduce(result, padded[1:-1, :-2])
+        return reduce(result, padded[1:-1, 2:])
+
+    def _blur(self, alpha):
+        radius = len(self._blur_kernel) // 2
+        data = alpha.astype(np.float32)
+        for axis in (0, 1):
+            pad = [(0, 0), (0, 0)]
+            pad[axis] = (radius, radius)
+            padded = np.pad(data, pad, mode="reflect")  # == BORDER_REFLECT_101
+            data = sum(weight * np.take(padded, range(tap, tap + alpha.shape[axis]), axis=axis)
+                       for tap, weight in enumerate(self._blur_kernel))
+        return np.clip(np.rint(data), 0, 255).astype(np.uint8)
+
+    def _mask_alpha(self, frame):
+        self._frame = _to_uint8(frame)
+        hsv = self._rgb_to_hsv(self._frame)
+        green = np.all((hsv >= self.lower) & (hsv <= self.upper), axis=2)
+        mask = np.where(green, 0, 255).astype(np.uint8)
+        mask = self._cross_filter(mask, np.minimum, 255)
+        return self._cross_filter(mask, np.maximum, 0)
+
+    def _refine_alpha(self, alpha):
+        alpha = np.where(alpha > self.alpha_thresh, 255, 0).astype(np.uint8)
+        for _ in range(self.shrink_pixels):
+            alpha = self._cross_filter(alpha, np.minimum, 255)
+        if self.feather > 0:
+            alpha = self._blur(alpha)
+        return alpha
+
+    def _compose(self, alpha):
+        if not self.refine_edges:
+            return np.dstack((self._frame, alpha))
+        premultiplied = (self._frame.astype(np.uint16) * alpha[:, :, None] + 127) // 255
+        return np.dstack((premultiplied.astype(np.uint8), alpha))
+
+
+class UMatChromaKeyer(ChromaKeyer):
+    """
+    The "hsv" / "morph" ChromaKeyer pipeline on cv2.UMat, OpenCV's transparent API: with a usable
+    OpenCL device the work runs there, otherwise OpenCV falls back to its CPU code.
+    The stage methods pass UMats to each other (OpenCL runs asynchronously, so instrument_keyer
+    mostly charges the work to "premultiply", where the result is downloaded).
+    Returns a new RGBA numpy array for every frame.
+    """
+
+    def __init__(self, **keyer_args):
+        super().__init__(**keyer_args)
+        if self.key_mode != "hsv" or self.edge_mode != "morph":
+            raise ValueError("The opencv_umat keying backend only supports key_mode='hsv' and edge_mode='morph'")
+
+    def key_alpha(self, frame):
+        return super().key_alpha(frame).get()
+
+    def key(self, frame):
+        # the stages pass UMats along, only the RGBA result is downloaded
+        return self._compose(super().key_alpha(frame))
+
+    def _mask_alpha(self, frame):
+        self._frame = cv2.UMat(np.ascontiguousarray(_to_uint8(frame)))
+        hsv = cv2.cvtColor(self._frame, cv2.COLOR_RGB2HSV)
+        mask = cv2.bitwise_not(cv2.inRange(hsv, self.lower, self.upper))
+        return cv2.morphologyEx(mask, cv2.MORPH_OPEN, self.kernel3, iterations=1)
+
+    def _refine_alpha(self, alpha):
+        _, alpha = cv2.threshold(alpha, self.alpha_thresh, 255, cv2.THRESH_BINARY)
+        if self.shrink_pixels > 0:
+            alpha = cv2.erode(alpha, self.kernel3, iterations=self.shrink_pixels)
+        if self.feather > 0:
+            alpha = cv2.GaussianBlur(alpha, self.blur_size, 0)
+        return alpha
+
+    def _compose(self, alpha):
+        if self.refine_edges:
+            rgba = cv2.cvtColor(self._frame, cv2.COLOR_RGB2RGBA)
+            rgba = cv2.multiply(rgba, cv2.merge((alpha, alpha, alpha, alpha)), scale=1.0 / 255.0)
+        else:
+            rgba = cv2.merge(list(cv2.split(self._frame)) + [alpha])
+        return rgba.get()
+
+
+KEYING_BACKENDS = {
+    "opencv": ChromaKeyer,
+    "numpy": NumpyChromaKeyer,
+    "opencv_umat": UMatChromaKeyer,
+}
+
+# backend picked by select_backend per (keyer arguments, frame size), measured once per process
+_selected_backends = {}
+
+
+def _benchmark_frame(width, height):
+    frame = np.zeros((height, width, 3), dtype=np.uint8)
+    frame[:, :] = (40, 190, 60)
+    yy, xx = np.mgrid[0:height, 0:width]
+    subject = ((xx - width / 2) / (width / 5)) ** 2 + ((yy - height / 2) / (height / 3)) ** 2 < 1
+    frame[subject] = (200, 120, 90)
+    return frame
+
+
+def _time_key(keyer, frame, repeat=1):
+    # best of `repeat` calls, and the (reused) result of the last one
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = keyer.key(frame)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def select_backend(sample_frame=None, frame_size=(640, 360), rounds=3, repeat=5, margin=0.2, crop_size=256,
+                   **keyer_args):
+    """
+    Name of the keying backend to use on this machine for `keyer_args`, from a short startup
+    benchmark on `sample_frame` (a frame of the clip, best with real subject edges; a synthetic
+    `frame_size` frame without one).
+    Other backends are screened against "opencv" first, cheapest test first: a `crop_size` center
+    crop (the warm-up, which also compiles OpenCL kernels), then one call on the whole frame whose
+    result must match OpenCV's up to rounding (2 levels). A backend clearly slower than OpenCV at
+    either step is dropped right there, so a slow one costs about one frame.
+    The survivors are timed `rounds` times, best of `repeat` calls per round, taking turns so a
+    load spike hits them alike. "opencv" stays the choice unless another backend is faster by more
+    than `margin` in every round (a backend that misses it once is dropped), of those the one with
+    the lowest total time wins.
+    The choice is remembered for the rest of the process per keyer arguments and frame size.
+    """
+    if sample_frame is not None:
+        frame = _to_uint8(sample_frame)
+        frame_size = (frame.shape[1], frame.shape[0])
+    key = (json.dumps(keyer_args, sort_keys=True, default=str), tuple(frame_size))
+    if key in _selected_backends:
+        return _selected_backends[key]
+    if sample_frame is None:
+        frame = _benchmark_frame(*frame_size)
+    height, width = frame.shape[:2]
+    y0 = max(0, (height - crop_size) // 2)
+    x0 = max(0, (width - crop_size) // 2)
+    crop = np.ascontiguousarray(frame[y0:y0 + crop_size, x0:x0 + crop_size])
+
+    keyers = {"opencv": ChromaKeyer(**keyer_args)}
+    keyers["opencv"].key(crop)
+    crop_time, _ = _time_key(keyers["opencv"], crop, repeat=3)
+    keyers["opencv"].key(frame)
+    frame_time, reference = _time_key(keyers["opencv"], frame)
+    reference = reference.astype(np.int16)
+    for name, keyer_class in KEYING_BACKENDS.items():
+        if name in keyers:
+            continue
+        try:
+            keyer = keyer_class(**keyer_args)
+            keyer.key(crop)
+            # small crops favour the CPU (no transfer cost to hide), only drop what is far behind
+            if _time_key(keyer, crop, repeat=3)[0] > 8 * crop_time:
+                continue
+            elapsed, result = _time_key(keyer, frame)
+        except (ValueError, cv2.error):
+            continue
+        if elapsed > 2 * frame_time or np.abs(result.astype(np.int16) - reference).max() > 2:
+            continue
+        keyers[name] = keyer
+
+    timings = {name: 0.0 for name in keyers}
+    for _ in range(rounds if len(keyers) > 1 else 0):
+        round_timings = {name: _time_key(keyer, frame, repeat)[0] for name, keyer in keyers.items()}
+        # a backend that did not win this round clearly is out, it is not timed again
+        keyers = {name: keyer for name, keyer in keyers.items()
+                  if name == "opencv" or round_timings[name] < (1 - margin) * round_timings["opencv"]}
+        for name in keyers:
+            timings[name] += round_timings[name]
+
+    selected = min(keyers, key=timings.get)
+    _selected_backends[key] = selected
+    return selected
+
+
+def create_keyer(backend="auto", sample_frame=None, frame_size=(640, 360), **keyer_args):
+    """
+    Keyer for `keyer_args` (ChromaKeyer arguments) on the given backend, one of KEYING_BACKENDS
+    or "auto" to let select_backend pick one for `sample_frame` (or frames of `frame_size`).
+    """
+    if backend == "auto":
+        backend = select_backend(sample_frame=sample_frame, frame_size=frame_size, **keyer_args)
+    if backend not in KEYING_BACKENDS:
+        raise ValueError(f"Unknown keying backend: {backend}")
+    return KEYING_BACKENDS[backend](**keyer_args)
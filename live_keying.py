@@ -0,0 +1,275 @@
+import pathlib
+import struct
+import sys
+import threading
+import time
+from multiprocessing import shared_memory
+import numpy as np
+from ffmpeg_decoder import FfmpegFrameReader
+from keying_engine import create_keyer
+
+current_path = pathlib.Path(__file__).parent
+
+
+class LatestFrame:
+    """
+    Reads an ffmpeg frame stream on a background thread and keeps only the newest frame.
+    A live source never waits for the keyer: a frame that is replaced before it was taken
+    counts as dropped ("overrun").
+    """
+
+    def __init__(self, reader: FfmpegFrameReader):
+        self.reader = reader
+        width, height = reader.size
+        self._frame = np.empty((height, width, 3), dtype=np.uint8)
+        self._index = -1
+        self._capture_time = 0.0
+        self._taken_index = -1
+        self._finished = False
+        self._stopped = False
+        self._error = None
+        self.received = 0
+        self.overruns = 0
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="live-reader", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        try:
+            for frame in self.reader:
+                if self._stopped:
+                    break  # closes the reader generator, which stops ffmpeg
+                with self._condition:
+                    if self._index > self._taken_index:
+                        self.overruns += 1
+                    np.copyto(self._frame, frame)
+                    self._capture_time = time.perf_counter()
+                    self._index += 1
+                    self.received += 1
+                    self._condition.notify()
+        except Exception as error:
+            self._error = error
+        finally:
+            with self._condition:
+                self._finished = True
+                self._condition.notify()
+
+    def stop(self, timeout=5.0):
+        """
+        Stop reading. The reader thread only notices between frames, a source that stalls longer
+        than `timeout` seconds is left to its daemon thread instead of blocking shutdown.
+        """
+        self._stopped = True
+        self._thread.join(timeout)
+
+    def take(self, out):
+        """
+        Wait for a frame newer than the last one taken and copy it into `out`.
+        Returns (frame index, capture time) or None once the stream has ended.
+        """
+        with self._condition:
+            while self._index <= self._taken_index and not self._finished:
+                self._condition.wait()
+            if self._error is not None:
+                raise self._error
+            if self._index <= self._taken_index:
+                return None
+            np.copyto(out, self._frame)
+            self._taken_index = self._index
+            return self._index, self._capture_time
+
+
+class RawPipeOutput:
+    """
+    Write keyed frames as raw RGBA bytes to a file, named pipe (os.mkfifo) or "-" for stdout.
+    """
+
+    def __init__(self, path="-"):
+        self.path = path
+        self._fp = sys.stdout.buffer if path == "-" else open(path, "wb")
+
+    def write(self, rgba, frame_index):
+        self._fp.write(memoryview(rgba).cast("B"))
+        self._fp.flush()
+
+    def close(self):
+        if self._fp is not sys.stdout.buffer:
+            self._fp.close()
+
+
+class SharedMemoryOutput:
+    """
+    Publish the latest keyed frame in a named shared memory block.
+    Layout: a 24 byte header (uint64 sequence, uint64 frame index, uint32 width, uint32 height)
+    followed by height * width * 4 RGBA bytes. The sequence is odd while a frame is being
+    written: readers copy the frame and retry if the sequence was odd or changed meanwhile.
+    """
+    HEADER = struct.Struct("<QQII")
+
+    def __init__(self, name, size):
+        width, height = size
+        self.name = name
+        self._memory = shared_memory.SharedMemory(name=name, create=True,
+                                                  size=self.HEADER.size + width * height * 4)
+        self._frame = np.ndarray((height, width, 4), dtype=np.uint8,
+                                 buffer=self._memory.buf, offset=self.HEADER.size)
+        self._sequence = 0
+        self._width = width
+        self._height = height
+        self.HEADER.pack_into(self._memory.buf, 0, 0, 0, width, height)
+
+    def write(self, rgba, frame_index):
+        self.HEADER.pack_into(self._memory.buf, 0, self._sequence + 1, frame_index, self._width, self._height)
+        np.copyto(self._frame, rgba)
+        self._sequence += 2
+        self.HEADER.pack_into(self._memory.buf, 0, self._sequence, frame_index, self._width, self._height)
+
+    def close(self):
+        self._frame = None
+        self._memory.close()
+        self._memory.unlink()
+
+
+class LiveStats:
+    """
+    Frame counters and per-stage latency (ms) since the last report.
+    Stages: "wait" capture -> keying start, "key" keying, "output" writing the frame,
+    "total" capture -> frame written.
+    """
+    STAGES = ("wait", "key", "output", "total")
+
+    def __init__(self):
+        self.keyed = 0
+        self.late = 0
+        self._reset_window()
+
+    def _reset_window(self):
+        self._sums = dict.fromkeys(self.STAGES, 0.0)
+        self._maxima = dict.fromkeys(self.STAGES, 0.0)
+        self._count = 0
+
+    def add(self, **stage_ms):
+        for stage, value in stage_ms.items():
+            self._sums[stage] += value
+            self._maxima[stage] = max(self._maxima[stage], value)
+        self._count += 1
+
+    def report(self, source: LatestFrame):
+        count = max(1, self._count)
+        stages = "  ".join(f"{stage} {self._sums[stage] / count:.1f}/{self._maxima[stage]:.1f}"
+                           for stage in self.STAGES)
+        self._reset_window()
+        return (f"received {source.received}  keyed {self.keyed}  dropped {source.overruns + self.late} "
+                f"(overrun {source.overruns}, late {self.late})  ms avg/max: {stages}")
+
+
+def key_live_stream(input_url,
+                    output,
+                    lower,
+                    upper,
+                    shrink_pixels=1,
+                    feather=1,
+                    key_mode="lut",
+                    edge_mode="morph",
+                    resolution=None,
+                    input_args=("-re",),
+                    latency_budget_ms=100,
+                    stats_interval=2.0,
+                    max_frames=None,
+                    backend="auto",
+                    source_size=None,
+                    source_fps=None):
+    """
+    Key a live stream frame by frame at the source frame rate.
+    input_url: anything ffmpeg can open, with `input_args` before -i ("-re" plays a file at its
+               native speed so a recording can stand in for a live source).
+    output: "pipe:<path>" (raw RGBA, "pipe:-" for stdout) or "shm:<name>" (see SharedMemoryOutput).
+    Dropping policy: the keyer always takes the newest frame, frames replaced before they were taken
+    are dropped (overrun), and a frame that already waited longer than `latency_budget_ms` when
+    keying would start is dropped as well (late) so the output never lags further behind.
+    backend: keying implementation, see keying_engine.create_keyer (picked for the stream's frame size).
+    source_size / source_fps: (width, height) and frame rate of the source, needed for a FIFO or
+                              stdin which can't be probed without consuming it (see FfmpegFrameReader).
+    Stats are printed to stderr every `stats_interval` seconds. Returns the final LiveStats.
+    """
+    reader = FfmpegFrameReader(input_url, resolution=resolution, input_args=input_args, size=source_size,
+                               fps=source_fps)
+    if not output.startswith(("pipe:", "shm:")):
+        raise ValueError(f"Unknown live output: {output}")
+    keyer = create_keyer(backend=backend,
+                         frame_size=reader.size,
+                         lower=lower,
+                         upper=upper,
+                         shrink_pixels=shrink_pixels,
+                         feather=feather,
+                         key_mode=key_mode,
+                         edge_mode=edge_mode)
+    stats = LiveStats()
+    frame = np.empty((reader.size[1], reader.size[0], 3), dtype=np.uint8)
+    # the output is opened last and always closed (a shared memory segment would outlive the process)
+    if output.startswith("pipe:"):
+        sink = RawPipeOutput(output[len("pipe:"):])
+    else:
+        sink = SharedMemoryOutput(output[len("shm:"):], reader.size)
+    source = None
+    try:
+        source = LatestFrame(reader).start()
+        next_report = time.perf_counter() + stats_interval
+        while max_frames is None or stats.keyed < max_frames:
+            taken = source.take(frame)
+            if taken is None:
+                break
+            frame_index, capture_time = taken
+            start = time.perf_counter()
+            wait_ms = (start - capture_time) * 1000
+            if wait_ms > latency_budget_ms:
+                stats.late += 1
+                continue
+
+            rgba = keyer.key(frame)
+            keyed = time.perf_counter()
+            sink.write(rgba, frame_index)
+            written = time.perf_counter()
+            stats.keyed += 1
+            stats.add(wait=wait_ms,
+                      key=(keyed - start) * 1000,
+                      output=(written - keyed) * 1000,
+                      total=(written - capture_time) * 1000)
+
+            if written >= next_report:
+                print(stats.report(source), file=sys.stderr)
+                next_report = written + stats_interval
+    finally:
+        if source is not None:
+            source.stop()
+        sink.close()
+    print(stats.report(source), file=sys.stderr)
+    return stats
+
+
+def main():
+    data_path = current_path.joinpath("data", "secrete", "secrete")
+    input_url = data_path.joinpath("input_01.mp4")  # or a capture device / stream url ffmpeg can open
+    input_args = ["-re"]  # read the recording at its native frame rate like a live source
+    output = "shm:greenscreen_live"  # or "pipe:-" / "pipe:<fifo path>"
+    lower = (37, 40, 40)  # for removing the color
+    upper = (85, 255, 255)  # for removing the color
+    shrink_pixels = 1  # how many pixels to remove around the object
+    feather = 1  # softness of the new edge
+    latency_budget_ms = 100  # frames waiting longer than this are dropped
+
+    key_live_stream(input_url=input_url,
+                    output=output,
+                    lower=lower,
+                    upper=upper,
+                    shrink_pixels=shrink_pixels,
+                    feather=feather,
+                    input_args=input_args,
+                    latency_budget_ms=latency_budget_ms)
+
+
+if __name__ == "__main__":
+    main()
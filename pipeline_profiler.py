@@ -0,0 +1,173 @@
+import bisect
+import json
+import sys
+import time
+
+# upper bounds (ms) of the timing histogram buckets, the last bucket takes everything slower
+HISTOGRAM_BOUNDS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+
+def peak_rss_mb():
+    """
+    Peak resident memory of this process in MB. Linux reports VmHWM of the process' own address
+    space, ru_maxrss would also include the parent's peak from before the fork/exec.
+    """
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def reset_peak_rss():
+    """
+    Start a new peak RSS measurement (Linux only), so every video of a batch reports its own peak.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except OSError:
+        pass
+
+
+class _StageStats:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(HISTOGRAM_BOUNDS_MS) + 1)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        self.buckets[bisect.bisect_left(HISTOGRAM_BOUNDS_MS, seconds * 1000)] += 1
+
+    def as_dict(self):
+        labels = [f"<={bound}" for bound in HISTOGRAM_BOUNDS_MS] + [f">{HISTOGRAM_BOUNDS_MS[-1]}"]
+        return {"count": self.count,
+                "total_ms": round(self.total * 1000, 3),
+                "mean_ms": round(self.total * 1000 / max(1, self.count), 3),
+                "max_ms": round(self.max * 1000, 3),
+                "histogram_ms": {label: n for label, n in zip(labels, self.buckets) if n}}
+
+
+class StageProfiler:
+    """
+    Per-stage timings of one video: every call of an instrumented stage adds its duration to a
+    running count / total / max and a fixed bucket histogram, so memory stays constant for any
+    clip length. Stages are timed where they run, writer threads included (every stage is only
+    updated from one thread). Nothing is instrumented unless a profiler is created, a disabled
+    run pays no overhead at all.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.stages = {}
+        self.frame_count = 0
+        self.started = time.time()
+        self._start = time.perf_counter()
+        reset_peak_rss()
+
+    def add(self, stage, seconds):
+        stats = self.stages.get(stage)
+        if stats is None:
+            stats = self.stages.setdefault(stage, _StageStats())
+        stats.add(seconds)
+
+    def wrap(self, stage, function):
+        """
+        `function` with every call timed as `stage`.
+        """
+        clock = time.perf_counter
+
+        def timed(*args, **kwargs):
+            start = clock()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add(stage, clock() - start)
+        return timed
+
+    def iter_stage(self, stage, iterable):
+        """
+        Yield from `iterable`, timing how long every item took to produce (e.g. decoding).
+        """
+        clock = time.perf_counter
+        iterator = iter(iterable)
+        while True:
+            start = clock()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.add(stage, clock() - start)
+            yield item
+
+    def report(self):
+        peak = peak_rss_mb()
+        return {"video": self.name,
+                "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+                "frames": self.frame_count,
+                "wall_seconds": round(time.perf_counter() - self._start, 3),
+                "peak_rss_mb": round(peak, 1) if peak is not None else None,
+                "stages": {stage: stats.as_dict() for stage, stats in self.stages.items()}}
+
+    def write_report(self, path):
+        """
+        Append this video's report as one JSON line to `path` and return it.
+        """
+        report = self.report()
+        with open(path, "a") as report_file:
+            report_file.write(json.dumps(report) + "\n")
+        return report
+
+
+def summary_table(report):
+    """
+    Short text table of a report: time per stage, per frame and as a share of the wall time.
+    Stages running on writer threads overlap the others, so the shares can add up to over 100%.
+    """
+    wall_ms = report["wall_seconds"] * 1000
+    lines = [f"{report['video']}: {report['frames']} frames in {report['wall_seconds']:.2f} s, "
+             f"peak RSS {report['peak_rss_mb']} MB",
+             f"  {'stage':<22}{'calls':>7}{'total s':>10}{'ms/call':>10}{'max ms':>10}{'wall %':>8}"]
+    stages = sorted(report["stages"].items(), key=lambda item: item[1]["total_ms"], reverse=True)
+    for stage, stats in stages:
+        lines.append(f"  {stage:<22}{stats['count']:>7}{stats['total_ms'] / 1000:>10.2f}{stats['mean_ms']:>10.2f}"
+                     f"{stats['max_ms']:>10.1f}{100 * stats['total_ms'] / max(wall_ms, 1e-9):>7.0f}%")
+    return "\n".join(lines)
+
+
+def instrument_keyer(keyer, profiler):
+    """
+    Time the stages of a ChromaKeyer (or TemporalChromaKeyer): "mask" (color test + opening),
+    "edges" (shrink / feather), "premultiply", and "rekey_tiles" for the temporal keyer.
+    The timed versions replace the methods on this keyer instance only.
+    """
+    keyer._mask_alpha = profiler.wrap("mask", keyer._mask_alpha)
+    keyer._refine_alpha = profiler.wrap("edges", keyer._refine_alpha)
+    keyer._compose = profiler.wrap("premultiply", keyer._compose)
+    if hasattr(keyer, "_rekey_changed_tiles"):
+        keyer._rekey_changed_tiles = profiler.wrap("rekey_tiles", keyer._rekey_changed_tiles)
+    return keyer
+
+
+def instrument_writer(writer, profiler):
+    """
+    Time every write of `writer` as "write_<class name>", and a GifWriter's palette conversion
+    (which runs inside its write) as "gif_quantize".
+    """
+    if getattr(writer, "frame_converter", None) is not None:
+        writer.frame_converter = profiler.wrap("gif_quantize", writer.frame_converter)
+    writer.write = profiler.wrap(f"write_{type(writer).__name__}", writer.write)
+    return writer
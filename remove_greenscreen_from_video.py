@@ -1,164 +1,345 @@
+import functools
+import itertools
+import json
+import multiprocessing
+import os
 import pathlib
+import queue
 import shutil
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
 from PIL import Image
 from moviepy import VideoFileClip
 import cv2
+from animation_writer import (ApngWriter, DedupWriter, FfmpegVideoWriter, GifWriter, GlobalPalette,
+                              PngSequenceWriter, ThreadedWriter, abort_writers, close_writers)
+from build_manifest import MANIFEST_FILE_NAME, BuildManifest
+from ffmpeg_decoder import FfmpegFrameReader, check_ranges, get_output_size, read_frames_at
+from frame_cache import cached_frames
+from keyed_frame_store import KeyedFrameStore, decode_frame, encode_frame
+from keying_engine import (TemporalChromaKeyer, create_keyer, key_frames, key_frames_pipelined, rgba_to_gif_frame,
+                           save_frames, select_backend)
+from pipeline_profiler import StageProfiler, instrument_keyer, instrument_writer, summary_table
 
 current_path = pathlib.Path(__file__).parent
 
 
-def _to_uint8(frame):
-    arr = np.asarray(frame)
-    if arr.dtype == np.uint8:
-        return arr
-    if np.issubdtype(arr.dtype, np.floating):
-        # MoviePy sometimes returns floats in 0..1 or 0..255
-        if arr.max() <= 1.1:
-            arr = (arr * 255.0).clip(0, 255)
-        else:
-            arr = arr.clip(0, 255)
-    return arr.astype(np.uint8)
-
-
-def apply_mask(frame, lower=(37, 40, 40), upper=(85, 255, 255)):
+def iter_keyed_frames(clip, times, keyer):
     """
-    Remove green background using HSV thresholding.
-    Returns an RGBA image where alpha is a binary-ish mask (0 or 255).
+    Decode (one get_frame per timestamp) and key the frames at `times` one at a time.
     """
-    frame_u8 = _to_uint8(frame)
-    hsv = cv2.cvtColor(frame_u8, cv2.COLOR_RGB2HSV)
-
-    # Mask for green (green -> 255)
-    mask_green = cv2.inRange(hsv, np.array(lower), np.array(upper))
-
-    # Foreground mask: non-green -> 255
-    fg_mask = cv2.bitwise_not(mask_green)
+    return key_frames((clip.get_frame(t) for t in times), keyer)
 
-    # Optional: small morphological opening to clean tiny spots
-    kernel3 = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
-    fg_mask = cv2.morphologyEx(fg_mask, cv2.MORPH_OPEN, kernel3, iterations=1)
 
-    # Return RGBA with alpha = fg_mask (0/255)
-    rgba = np.dstack((frame_u8, fg_mask))
-    return rgba
+def open_clip(input_path, resolution=None):
+    clip = VideoFileClip(str(input_path))
+    if resolution is not None:
+        width, height = get_output_size(clip.size, resolution)
+        clip = clip.resized(new_size=(width, height))
+    return clip
 
 
-def expand_transparency(rgba, shrink_pixels=0, feather=5, alpha_thresh=1):
+def range_times(duration, fps_out, ranges=None):
     """
-    Expand the transparent area by `shrink_pixels`:
-      - erode the binary foreground mask `shrink_pixels` times (3x3 ellipse kernel)
-      - blur (feather) the eroded mask to make smooth edges
-      - premultiply RGB by the resulting alpha to avoid green fringing
-    Parameters:
-      shrink_pixels: int, number of pixels to remove from object edge (>=0)
-      feather: int, radius for gaussian blur (>=0). Final kernel = 2*feather+1 (odd).
-      alpha_thresh: pixels with alpha <= this are considered fully transparent (used only if needed)
+    Timestamps every 1 / fps_out seconds over the whole clip, or within each (start, end) range
+    in order (end None = to the end of the clip).
     """
-    # Separate
-    rgb = rgba[:, :, :3].astype(np.uint8)
-    alpha = rgba[:, :, 3].astype(np.uint8)
-
-    # Ensure binary mask (0 or 255) from alpha
-    bin_mask = (alpha > alpha_thresh).astype(np.uint8) * 255
+    if not ranges:
+        return np.arange(0, duration, 1.0 / fps_out)
+    check_ranges(ranges)
+    return np.concatenate([np.arange(start, duration if end is None else min(end, duration), 1.0 / fps_out)
+                           for start, end in ranges])
 
-    if shrink_pixels > 0:
-        # Use a small ellipse kernel and perform `shrink_pixels` iterations
-        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
-        eroded = cv2.erode(bin_mask, kernel, iterations=shrink_pixels)
-    else:
-        eroded = bin_mask
 
-    # Feather / smooth the alpha (make sure kernel is odd and >=1)
-    if feather and feather > 0:
-        k = max(1, int(feather) * 2 + 1)
-        eroded_blurred = cv2.GaussianBlur(eroded, (k, k), 0)
-    else:
-        eroded_blurred = eroded
-
-    # Make sure alpha is 0..255 uint8
-    new_alpha = np.clip(eroded_blurred, 0, 255).astype(np.uint8)
-
-    # Premultiply RGB by alpha to avoid leftover green fringes at semi-transparent edges
-    # alpha_scale shape (H, W, 1)
-    alpha_scale = (new_alpha.astype(np.float32) / 255.0)[:, :, None]
-    premult_rgb = (rgb.astype(np.float32) * alpha_scale).round().astype(np.uint8)
-
-    out_rgba = np.dstack((premult_rgb, new_alpha))
-    return out_rgba
+def iter_clip_frames(input_path, fps_out, resolution=None, ranges=None):
+    """
+    Decode the frames at every 1 / fps_out seconds with moviepy (what iter_keyed_frames keys).
+    """
+    with open_clip(input_path, resolution) as clip:
+        for t in range_times(clip.duration, fps_out, ranges):
+            yield clip.get_frame(t)
 
 
-def rgba_to_gif_frame(rgba_frame: Image.Image, alpha_cutoff=128):
+def middle_frame(input_path, resolution=None, ranges=None):
     """
-    Convert an RGBA image to a GIF frame (P-mode) with transparency,
-    without introducing a fake magenta marker color.
+    One decoded frame from the middle of the clip (of the first of `ranges`), e.g. to pick the
+    keying backend on.
     """
-    rgba = rgba_frame.convert("RGBA")
-    arr = np.array(rgba)
+    duration = FfmpegFrameReader(input_path).duration
+    start, end = ranges[0] if ranges else (0, None)
+    end = duration if end is None else min(end, duration)
+    return read_frames_at(input_path, [(start + end) / 2], resolution)[0]
 
-    # Binary mask: alpha below cutoff → transparent
-    alpha = arr[:, :, 3]
-    mask_transparent = alpha <= alpha_cutoff
 
-    # Fill transparent areas with black (or any safe color)
-    arr_rgb = arr[:, :, :3].copy()
-    arr_rgb[mask_transparent] = (0, 0, 0)
+def sample_times(duration, sample_count, ranges=None):
+    """
+    `sample_count` timestamps evenly spaced over the clip, or over the `ranges` (see range_times)
+    taken together, so every sample lies inside a range.
+    """
+    spans = [(start, duration if end is None else min(end, duration)) for start, end in ranges or [(0, None)]]
+    starts = np.array([start for start, _ in spans], dtype=np.float64)
+    lengths = np.array([max(0.0, end - start) for start, end in spans])
+    ends = np.cumsum(lengths)
+    offsets = np.linspace(0, ends[-1], sample_count, endpoint=False)
+    span = np.minimum(np.searchsorted(ends, offsets, side="right"), len(spans) - 1)
+    return starts[span] + offsets - (ends[span] - lengths[span])
 
-    # Convert back to image
-    tmp = Image.fromarray(arr_rgb, mode="RGB")
 
-    # Quantize to P mode (max 255 colors for GIF + 1 reserved for transparency)
-    pal = tmp.convert("P", palette="ADAPTIVE", colors=255)
+def key_sample_frames(input_path, keyer, sample_count=16, resolution=None, ranges=None, decoder="moviepy") -> list:
+    """
+    Key `sample_count` evenly spaced frames of the clip, or of its `ranges` (copies, safe to keep).
+    decoder "ffmpeg" reads them with one fast seek each (see read_frames_at), otherwise moviepy.
+    """
+    if decoder == "ffmpeg":
+        times = sample_times(FfmpegFrameReader(input_path).duration, sample_count, ranges)
+        return [rgba.copy() for rgba in key_frames(read_frames_at(input_path, times, resolution), keyer)]
+    with open_clip(input_path, resolution) as clip:
+        times = sample_times(clip.duration, sample_count, ranges)
+        return [rgba.copy() for rgba in iter_keyed_frames(clip=clip, times=times, keyer=keyer)]
 
-    # Find closest color to our fill color (0,0,0 here)
-    palette = pal.getpalette()
-    if palette is None:
-        palette = []
-    palette = palette + [0] * (768 - len(palette))
 
-    # Look for black in palette
-    marker_index = None
-    for i in range(256):
-        r, g, b = palette[3 * i:3 * i + 3]
-        if (r, g, b) == (0, 0, 0):
-            marker_index = i
-            break
-    if marker_index is None:
-        marker_index = 0
+_worker_clip = None
+_worker_keyer = None
+_worker_ready = None
+_worker_stop = None
 
-    # Apply transparency where alpha was low
-    pal.info["transparency"] = marker_index
-    pal.info["disposal"] = 2
 
-    return pal
+def _init_key_worker(input_path, keyer, ready, stop, resolution=None):
+    """
+    Process pool initializer: every worker opens its own decoder and receives the keyer once,
+    plus the queue that announces spooled frames and the event that cancels the runs.
+    """
+    global _worker_clip, _worker_keyer, _worker_ready, _worker_stop
+    # the pool already spreads the work over all cores, keep OpenCV single-threaded per worker
+    cv2.setNumThreads(1)
+    _worker_clip = open_clip(input_path, resolution)
+    _worker_keyer = keyer
+    _worker_ready = ready
+    _worker_stop = stop
 
 
-def save_frames(output_folder,
-                clip,
-                times,
-                lower,
-                upper,
-                shrink_pixels=0,
-                feather=5,
-                save_images=False) -> list:
-    frames = []
-    for i, t in enumerate(times):
-        frame = clip.get_frame(t)
-        rgba = apply_mask(frame, lower=lower, upper=upper)
+def _key_run(run_index, times, spool_file):
+    """
+    Key one contiguous run of `times` front to back and append every frame compressed to
+    `spool_file`, announcing (run_index, offset, length, shape) on the ready queue once written.
+    """
+    offset = 0
+    with open(spool_file, "wb") as fp:
+        for rgba in iter_keyed_frames(clip=_worker_clip, times=times, keyer=_worker_keyer):
+            if _worker_stop.is_set():
+                return
+            data = encode_frame(rgba)
+            fp.write(data)
+            fp.flush()
+            _worker_ready.put((run_index, offset, len(data), rgba.shape))
+            offset += len(data)
+
+
+def iter_keyed_frames_parallel(input_path,
+                               times,
+                               keyer,
+                               workers=None,
+                               resolution=None):
+    """
+    Key the frames at `times` on a pool of worker processes.
+    `times` is split into one contiguous run per worker, each worker decodes its run front to
+    back with its own VideoFileClip (one seek, no frame decoded twice) and its own copy of `keyer`.
+    Workers don't wait for the consumer: they spool their keyed frames compressed to a temporary
+    folder (see keyed_frame_store.encode_frame) and the frames are read back and yielded in order,
+    so memory stays at a frame per process however long the clip is, a run's file is deleted
+    once it was yielded.
+    """
+    if not len(times):
+        return
+    workers = min(workers or os.cpu_count() or 1, len(times))
+    runs = np.array_split(np.asarray(times), workers)
+    ready = multiprocessing.Queue()
+    stop = multiprocessing.Event()
+
+    with tempfile.TemporaryDirectory(prefix="keyed_runs_") as spool_folder, \
+            ProcessPoolExecutor(max_workers=workers,
+                                initializer=_init_key_worker,
+                                initargs=(str(input_path), keyer, ready, stop, resolution)) as executor:
+        spool_files = [pathlib.Path(spool_folder).joinpath(f"run_{index:03d}.bin") for index in range(workers)]
+        futures = [executor.submit(_key_run, index, run, spool_file)
+                   for index, (run, spool_file) in enumerate(zip(runs, spool_files))]
+        announced = [deque() for _ in runs]
+
+        def next_frame(index):
+            while not announced[index]:
+                try:
+                    run_index, offset, length, shape = ready.get(timeout=1.0)
+                except queue.Empty:
+                    # a failed run never announces its frames, raise its error instead of waiting
+                    for future in futures:
+                        if future.done() and future.exception() is not None:
+                            raise future.exception()
+                    continue
+                announced[run_index].append((offset, length, shape))
+            return announced[index].popleft()
+
+        try:
+            for index, run in enumerate(runs):
+                offset, length, shape = next_frame(index)
+                with open(spool_files[index], "rb") as fp:
+                    for frame_number in range(len(run)):
+                        if frame_number:
+                            offset, length, shape = next_frame(index)
+                        fp.seek(offset)
+                        yield decode_frame(fp.read(length), shape)
+                spool_files[index].unlink()
+            for future in futures:
+                future.result()
+        finally:
+            stop.set()
+
+
+def alpha_bbox(rgba):
+    """
+    (x, y, width, height) of the non-transparent pixels, at least 1x1 so it can always be encoded.
+    """
+    x, y, width, height = cv2.boundingRect(rgba[:, :, 3])
+    if width == 0 or height == 0:
+        return 0, 0, 1, 1
+    return x, y, width, height
 
-        # expand transparent area (shrink the object)
-        if shrink_pixels > 0 or (feather and feather > 0):
-            rgba = expand_transparency(rgba, shrink_pixels=shrink_pixels, feather=feather)
 
-        # save PNG frame
-        image_item = Image.fromarray(rgba)
-        if save_images:
-            png_path = output_folder.joinpath(f"frame_{i:05d}.png")
-            image_item.save(png_path)
+def crop_frames_tracked(frames, crop_info):
+    """
+    Crop every frame to its own foreground box, yields (rgba, offset).
+    The first frame stays full size so writers pick up the canvas size from it,
+    the per-frame boxes are recorded in `crop_info["frames"]`.
+    """
+    boxes = []
+    crop_info["mode"] = "tracked"
+    crop_info["frames"] = boxes
+    for i, rgba in enumerate(frames):
+        if i == 0:
+            crop_info["source_size"] = [rgba.shape[1], rgba.shape[0]]
+            boxes.append([0, 0, rgba.shape[1], rgba.shape[0]])
+            yield rgba, (0, 0)
+            continue
+        x, y, width, height = alpha_bbox(rgba)
+        boxes.append([x, y, width, height])
+        yield rgba[y:y + height, x:x + width], (x, y)
+
+
+def crop_frames_union(frames, crop_info):
+    """
+    Crop all frames to the union of their foreground boxes, yields (rgba, (0, 0)).
+    The union is only known after the last frame, so the first pass spools each frame's own
+    foreground box to a temporary file (memory stays flat) and the second pass places them
+    on a canvas of the union size. The union offset is recorded in `crop_info["offset"]`.
+    """
+    boxes = []
+    with tempfile.TemporaryFile() as spool:
+        for rgba in frames:
+            x, y, width, height = alpha_bbox(rgba)
+            boxes.append((x, y, width, height))
+            spool.write(np.ascontiguousarray(rgba[y:y + height, x:x + width]).tobytes())
+            crop_info["source_size"] = [rgba.shape[1], rgba.shape[0]]
+        if not boxes:
+            return
+
+        union_x0 = min(box[0] for box in boxes)
+        union_y0 = min(box[1] for box in boxes)
+        union_x1 = max(box[0] + box[2] for box in boxes)
+        union_y1 = max(box[1] + box[3] for box in boxes)
+        crop_info["mode"] = "union"
+        crop_info["offset"] = [union_x0, union_y0]
+        crop_info["size"] = [union_x1 - union_x0, union_y1 - union_y0]
+
+        spool.seek(0)
+        canvas = np.zeros((union_y1 - union_y0, union_x1 - union_x0, 4), dtype=np.uint8)
+        for x, y, width, height in boxes:
+            crop = np.frombuffer(spool.read(width * height * 4), dtype=np.uint8).reshape(height, width, 4)
+            canvas.fill(0)
+            canvas[y - union_y0:y - union_y0 + height, x - union_x0:x - union_x0 + width] = crop
+            yield canvas, (0, 0)
+
+
+def checkerboard(height, width, cell=8, colors=(204, 153)):
+    """
+    Gray checkerboard (height, width, 3) uint8 used as background to show transparency.
+    """
+    yy, xx = np.indices((height, width))
+    board = np.where(((yy // cell) + (xx // cell)) % 2 == 0, colors[0], colors[1]).astype(np.uint8)
+    return np.repeat(board[:, :, None], 3, axis=2)
 
-        frames.append(image_item)
 
-    return frames
+def keyed_frame_stats(rgba):
+    """
+    Alpha coverage of a keyed frame: share of visible / fully opaque pixels and the number of
+    semi-transparent edge pixels (0 < alpha < 255), plus the foreground box.
+    """
+    alpha = rgba[:, :, 3]
+    pixel_count = alpha.size
+    visible = cv2.countNonZero(alpha)
+    opaque = cv2.countNonZero(cv2.compare(alpha, 255, cv2.CMP_EQ))
+    return {"coverage": round(visible / pixel_count, 4),
+            "opaque": round(opaque / pixel_count, 4),
+            "edge_pixels": int(visible - opaque),
+            "bbox": list(alpha_bbox(rgba)) if visible else None}
+
+
+def preview_video_file(input_path,
+                       output_path,
+                       lower,
+                       upper,
+                       sample_count=12,
+                       resolution=(320, -1),
+                       columns=4,
+                       shrink_pixels=1,
+                       feather=1,
+                       key_mode="hsv",
+                       softness=0,
+                       edge_mode="morph",
+                       backend="auto"):
+    """
+    Quick check of the keying parameters: key `sample_count` evenly spaced frames (fast seek,
+    see read_frames_at) at a reduced `resolution` and write <name>_preview.png (the keyed frames in a grid on a checkerboard) and
+    <name>_preview.json (keyed_frame_stats per sampled frame). Returns the stats.
+    """
+    duration = FfmpegFrameReader(input_path).duration
+    times = np.linspace(0, duration, sample_count, endpoint=False)
+    decoded = read_frames_at(input_path, times, resolution)
+    keyer = create_keyer(backend=backend,
+                         sample_frame=decoded[len(decoded) // 2],
+                         lower=lower,
+                         upper=upper,
+                         shrink_pixels=shrink_pixels,
+                         feather=feather,
+                         key_mode=key_mode,
+                         softness=softness,
+                         edge_mode=edge_mode)
+    frames = [rgba.copy() for rgba in key_frames(decoded, keyer)]
+
+    height, width = frames[0].shape[:2]
+    rows = (len(frames) + columns - 1) // columns
+    sheet = checkerboard(rows * height, columns * width)
+    stats = []
+    for index, (t, rgba) in enumerate(zip(times, frames)):
+        y = (index // columns) * height
+        x = (index % columns) * width
+        cell = sheet[y:y + height, x:x + width]
+        rgb = rgba[:, :, :3]
+        if not keyer.refine_edges:
+            # without shrink / feather the keyer returns straight RGB, premultiply it for the blend
+            rgb = cv2.multiply(rgb, cv2.merge([rgba[:, :, 3]] * 3), scale=1 / 255)
+        # premultiplied: out = rgb + background * (1 - alpha)
+        background = cv2.multiply(cell, cv2.merge([255 - rgba[:, :, 3]] * 3), scale=1 / 255)
+        cv2.add(rgb, background, dst=cell)
+        cv2.putText(cell, f"{t:.2f}s", (4, 14), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 0, 255), 1, cv2.LINE_AA)
+        stats.append({"time": round(float(t), 3), **keyed_frame_stats(rgba)})
+
+    output_path.mkdir(parents=True, exist_ok=True)
+    Image.fromarray(sheet).save(output_path.joinpath(f"{input_path.stem}_preview.png"))
+    with open(output_path.joinpath(f"{input_path.stem}_preview.json"), "w") as stats_file:
+        json.dump({"lower": list(lower), "upper": list(upper), "frames": stats}, stats_file, indent=2)
+    return stats
 
 
 def handle_video_file(input_path,
@@ -170,53 +351,327 @@ def handle_video_file(input_path,
                       shrink_pixels=1,
                       feather=1,
                       sape_png=False,
-                      save_gif=True,):
+                      save_gif=True,
+                      workers=1,
+                      decoder="moviepy",
+                      resolution=None,
+                      key_mode="hsv",
+                      softness=0,
+                      edge_mode="morph",
+                      incremental_keying=False,
+                      crop=None,
+                      gif_palette="adaptive",
+                      palette_sample_frames=16,
+                      gif_delta=False,
+                      gif_delta_tolerance=0,
+                      save_webm=False,
+                      save_prores=False,
+                      threaded_writers=True,
+                      frame_cache=False,
+                      profile_file=None,
+                      backend="auto",
+                      key_threads=0,
+                      start=None,
+                      end=None,
+                      ranges=None,
+                      resumable=False,
+                      dedupe=True):
+    """
+    Key a green screen video and write the requested outputs.
+    workers: number of processes used for keying, 1 keys in this process, None uses all cores.
+    decoder: "moviepy" seeks to every output timestamp with get_frame,
+             "ffmpeg" streams the clip once in order with fps decimation done by ffmpeg
+             (single process only, the worker processes always use moviepy).
+    resolution: optional (width, height) to key at, one side may be -1 to keep the aspect ratio.
+    key_mode: "hsv" thresholds every frame in HSV, "lut" keys through a cached RGB -> alpha cube,
+              softness > 0 (lut only) gives a soft alpha ramp outside the thresholds.
+    edge_mode: "morph" erodes/blurs (cost grows with shrink_pixels/feather), "distance" shrinks and
+               feathers from one distance transform at the same cost for any radius.
+    incremental_keying: only re-key the tiles that changed since the previous frame (locked-off camera),
+                        see TemporalChromaKeyer.
+    crop: None writes full frames, "union" crops the whole clip to the union of the foreground
+          boxes, "tracked" stores every frame as its own foreground box on the full canvas.
+          The offsets are written to <name>_crop.json next to the outputs.
+    gif_palette: "adaptive" quantizes every GIF frame on its own, "global" builds one palette from
+                 `palette_sample_frames` keyed frames evenly spaced over the keyed part (start / end /
+                 ranges) and maps all frames through it.
+    gif_delta: store only the changed rectangle of every GIF frame (best with gif_palette="global"),
+               gif_delta_tolerance > 0 also ignores color changes up to that size per channel.
+    save_webm / save_prores: also encode <name>.webm (VP9 with alpha) / <name>.mov (ProRes 4444)
+                             with ffmpeg from the same keyed frames.
+    threaded_writers: run every output format on its own thread, so the frames are decoded and
+                      keyed once and the formats encode in parallel.
+    frame_cache: keep the decoded frames for (file, fps_out, resolution, decoder) in a memory mapped
+                 file (see frame_cache.py) and key from it, so re-running with new keying parameters
+                 skips decoding. Keying then runs in this process, `workers` is ignored.
+    profile_file: append per-stage timings (decode, mask, edges, premultiply, GIF quantize, every
+                  writer), the frame count and the peak memory of this video as one JSON line to
+                  this file and print a summary table (see pipeline_profiler.py).
+    backend: keying implementation, "opencv", "numpy", "opencv_umat" or "auto" to pick one on a frame
+             of this clip (see keying_engine.select_backend). incremental_keying always uses opencv.
+    key_threads: 0 keys in this thread, otherwise decoding, keying on `key_threads` threads (None uses
+                 all cores) and writing overlap in this process (see keying_engine.key_frames_pipelined).
+                 Applies when keying runs in this process (workers=1 or frame_cache), not with incremental_keying.
+    start / end: only key this part of the clip (seconds, either may be left out).
+    ranges: list of (start, end) parts keyed one after the other into the same outputs (overrides
+            start / end). The ffmpeg decoder seeks to the keyframe before every part and decodes all
+            parts in one process, moviepy seeks per frame anyway.
+    resumable: checkpoint the keyed frames in <name>_checkpoint next to the outputs (see
+               keyed_frame_store.py). A run that died is restarted with the same arguments: the
+               stored frames are written again without keying and keying continues after them.
+               The checkpoint is removed once all outputs are written.
+    dedupe: runs of identical frames are written to the GIF / APNG once, as one longer frame
+            (see animation_writer.DedupWriter). The PNG sequence and the videos keep every frame.
+    Returns the paths written: the frame folder, one file per format and the crop offsets.
+    """
     input_file_name = input_path.stem
     output_folder = output_path.joinpath(input_file_name)
     if output_folder.exists():
         shutil.rmtree(output_folder)
     output_folder.mkdir(parents=True, exist_ok=True)
 
-    clip = VideoFileClip(str(input_path))
-    duration = clip.duration
-    times = np.arange(0, duration, 1.0 / fps_out)
+    frame_duration = int(1000 / fps_out)
+    if ranges is None and (start is not None or end is not None):
+        ranges = [(start or 0, end)]
 
-    frames = save_frames(output_folder=output_folder,
-                         clip=clip,
-                         times=times,
-                         shrink_pixels=shrink_pixels,
-                         feather=feather,
-                         save_images=save_images,
-                         lower=lower,
-                         upper=upper)
+    keyer_args = dict(lower=lower,
+                      upper=upper,
+                      shrink_pixels=shrink_pixels,
+                      feather=feather,
+                      key_mode=key_mode,
+                      softness=softness,
+                      edge_mode=edge_mode)
+    if backend == "auto" and not incremental_keying:
+        # pick once, on a real frame at the output resolution, for every keyer of this video
+        backend = select_backend(sample_frame=middle_frame(input_path, resolution, ranges), **keyer_args)
+    keyer = TemporalChromaKeyer(**keyer_args) if incremental_keying else create_keyer(backend=backend, **keyer_args)
+    profiler = StageProfiler(input_path.name) if profile_file is not None else None
+
+    writers = []
+    if save_images:
+        writers.append(PngSequenceWriter(output_folder))
     if sape_png:
-        frames[0].save(
-            output_path.joinpath(f"{input_file_name}.png"),
-            save_all=True,
-            append_images=frames[1:],
-            duration=int(1000 / fps_out),
-            loop=0,
-            format="PNG"  # APNG
-        )
-    if save_gif:
-        # ---- GIF: convert frames to paletted frames (preserve transparency) and set disposal=2 ----
-        gif_frames = [rgba_to_gif_frame(f) for f in frames]
-
-        # Ensure every frame has disposal=2 (replace frame)
-        for gf in gif_frames:
-            gf.info['disposal'] = 2
-
-        # Save GIF (disposal=2 passed explicitly as well)
-        gif_frames[0].save(
-            output_path.joinpath(f"{input_file_name}.gif"),
-            save_all=True,
-            append_images=gif_frames[1:],
-            duration=int(1000 / fps_out),
-            loop=0,
-            disposal=2,
-            optimize=False,
-            # Pillow will use the 'transparency' info set on each frame
-        )
+        # tracked frames only hold their own box, clear it before the next one is drawn
+        writers.append(ApngWriter(output_path.joinpath(f"{input_file_name}.png"),
+                                  duration=frame_duration,
+                                  loop=0,
+                                  dispose_op=1 if crop == "tracked" else 0,
+                                  delta=True))
+    if save_gif and gif_palette == "global":
+        samples = key_sample_frames(input_path,
+                                    keyer=create_keyer(backend=backend, **keyer_args),
+                                    sample_count=palette_sample_frames,
+                                    resolution=resolution,
+                                    ranges=ranges,
+                                    decoder=decoder)
+        writers.append(GifWriter(output_path.joinpath(f"{input_file_name}.gif"),
+                                 duration=frame_duration,
+                                 loop=0,
+                                 disposal=2,
+                                 global_palette=GlobalPalette.from_frames(samples),
+                                 delta=gif_delta,
+                                 delta_tolerance=gif_delta_tolerance))
+    elif save_gif:
+        # GIF: every frame is converted to a paletted frame (preserve transparency) with disposal=2
+        writers.append(GifWriter(output_path.joinpath(f"{input_file_name}.gif"),
+                                 duration=frame_duration,
+                                 loop=0,
+                                 disposal=2,
+                                 frame_converter=rgba_to_gif_frame,
+                                 delta=gif_delta,
+                                 delta_tolerance=gif_delta_tolerance))
+    if save_webm:
+        writers.append(FfmpegVideoWriter(output_path.joinpath(f"{input_file_name}.webm"), fps=fps_out, codec="vp9"))
+    if save_prores:
+        writers.append(FfmpegVideoWriter(output_path.joinpath(f"{input_file_name}.mov"), fps=fps_out, codec="prores"))
+    outputs = [output_folder] + [writer.path for writer in writers if not isinstance(writer, PngSequenceWriter)]
+    if profiler is not None:
+        writers = [instrument_writer(writer, profiler) for writer in writers]
+    if dedupe:
+        writers = [DedupWriter(writer) if isinstance(writer, (ApngWriter, GifWriter)) else writer for writer in writers]
+    if threaded_writers:
+        writers = [ThreadedWriter(writer) for writer in writers]
+
+    store = None
+    skip = 0
+    if resumable:
+        store = KeyedFrameStore(output_path.joinpath(f"{input_file_name}_checkpoint"),
+                                input_path=input_path,
+                                params=dict(keyer_args, fps_out=fps_out, resolution=resolution, decoder=decoder,
+                                            ranges=ranges))
+        skip = store.frame_count
+        if skip:
+            print(f"Resuming {input_path.name} after {skip} checkpointed frames")
+
+    clip = None
+    if frame_cache:
+        if decoder == "ffmpeg":
+            decode = functools.partial(FfmpegFrameReader, input_path, fps_out=fps_out, resolution=resolution,
+                                       ranges=ranges)
+        else:
+            decode = functools.partial(iter_clip_frames, input_path, fps_out=fps_out, resolution=resolution,
+                                       ranges=ranges)
+        decoded = cached_frames(input_path,
+                                decode=decode,
+                                fps_out=fps_out,
+                                resolution=resolution,
+                                decoder="ffmpeg" if decoder == "ffmpeg" else "moviepy",
+                                ranges=ranges)[skip:]
+    elif workers == 1 and decoder == "ffmpeg" and skip and not ranges:
+        # continue with a fast seek to the first frame that is not checkpointed
+        decoded = FfmpegFrameReader(input_path, fps_out=fps_out, resolution=resolution,
+                                    ranges=[(skip / fps_out, None)])
+    elif workers == 1 and decoder == "ffmpeg":
+        decoded = FfmpegFrameReader(input_path, fps_out=fps_out, resolution=resolution, ranges=ranges)
+        decoded = itertools.islice(decoded, skip, None)
+    elif workers == 1:
+        clip = open_clip(input_path, resolution)
+        times = range_times(clip.duration, fps_out, ranges)[skip:]
+        decoded = (clip.get_frame(t) for t in times)
+    else:
+        decoded = None
+        with VideoFileClip(str(input_path)) as probe_clip:
+            times = range_times(probe_clip.duration, fps_out, ranges)[skip:]
+        frames = iter_keyed_frames_parallel(input_path=input_path,
+                                            times=times,
+                                            keyer=keyer,
+                                            workers=workers,
+                                            resolution=resolution)
+        if profiler is not None:
+            # decoding and keying happen in the worker processes, only their combined time is seen here
+            frames = profiler.iter_stage("decode_key_workers", frames)
+    if decoded is not None and key_threads != 0 and not incremental_keying:
+        if profiler is not None:
+            decoded = profiler.iter_stage("decode", decoded)
+        frames = key_frames_pipelined(decoded,
+                                      make_keyer=functools.partial(create_keyer, backend=backend, **keyer_args),
+                                      key_threads=key_threads)
+        if profiler is not None:
+            # keying overlaps with decoding and writing, only the wait for the next keyed frame is seen here
+            frames = profiler.iter_stage("key_pipeline_wait", frames)
+    elif decoded is not None:
+        if profiler is not None:
+            decoded = profiler.iter_stage("decode", decoded)
+            instrument_keyer(keyer, profiler)
+        frames = key_frames(decoded, keyer)
+    if store is not None:
+        frames = store.resume(frames)
+    crop_info = {}
+    if crop == "union":
+        frames = crop_frames_union(frames, crop_info)
+    elif crop == "tracked":
+        frames = crop_frames_tracked(frames, crop_info)
+    elif crop is not None:
+        raise ValueError(f"Unknown crop mode: {crop}")
+    try:
+        frame_count = save_frames(frames=frames, writers=writers)
+    except BaseException:
+        # a half written GIF / APNG still plays, don't leave one behind that looks complete
+        abort_writers(writers)
+        raise
+    else:
+        close_writers(writers)
+    finally:
+        if clip is not None:
+            clip.close()
+    if store is not None:
+        store.remove()
+
+    if crop_info:
+        outputs.append(output_path.joinpath(f"{input_file_name}_crop.json"))
+        with open(outputs[-1], "w") as crop_file:
+            json.dump(crop_info, crop_file, indent=2)
+
+    if profiler is not None:
+        profiler.frame_count = frame_count
+        print(summary_table(profiler.write_report(profile_file)))
+    return outputs
+
+
+def _init_batch_worker(threads):
+    """
+    Process pool initializer for handle_video_files: every video process gets its share of the
+    thread budget (OpenCV, and the APNG compression threads which follow OpenCV's count).
+    """
+    cv2.setNumThreads(threads)
+
+
+def _handle_batch_video(video_path, video_args):
+    start = time.perf_counter()
+    outputs = handle_video_file(input_path=video_path, **video_args)
+    return time.perf_counter() - start, outputs
+
+
+def _error_summary(error):
+    # decoder errors carry ffmpeg's whole log, its last line names the problem
+    lines = str(error).strip().splitlines()
+    return f"{type(error).__name__}: {lines[-1]}" if lines else type(error).__name__
+
+
+def handle_video_files(video_paths, workers=None, thread_budget=None, manifest=None, **video_args) -> dict:
+    """
+    Run handle_video_file(input_path=path, **video_args) for every path on a pool of `workers`
+    processes (None uses all cores, 1 runs in this process), largest file first so a long video
+    doesn't start last. The pool shares `thread_budget` threads (default: the CPU count): every
+    process keeps OpenCV to thread_budget // processes threads so the pool doesn't oversubscribe
+    the machine, with one worker this process uses the whole budget. Keying inside a video runs single-process (video_args["workers"] = 1).
+    manifest: optional build_manifest.BuildManifest, videos whose content and video_args are
+              unchanged since they were recorded (and whose outputs exist) are skipped untouched.
+    Progress is printed as videos finish, a failing video is reported and the rest continue.
+    Returns {path: error message} for the videos that failed.
+    """
+    video_args = dict(video_args, workers=1)
+    video_paths = list(video_paths)
+    if manifest is not None:
+        changed = [path for path in video_paths if not manifest.is_current(str(path), [path], video_args)]
+        if len(changed) < len(video_paths):
+            print(f"Skipping {len(video_paths) - len(changed)} unchanged videos")
+        video_paths = changed
+    video_paths = sorted(video_paths, key=lambda path: path.stat().st_size, reverse=True)
+    thread_budget = thread_budget or os.cpu_count() or 1
+    workers = min(workers or os.cpu_count() or 1, max(1, len(video_paths)))
+    threads = max(1, thread_budget // workers)
+    failed = {}
+
+    def report(index, video_path, result=None, error=None):
+        if error is None:
+            seconds, outputs = result
+            if manifest is not None:
+                manifest.record(str(video_path), [video_path], video_args, outputs)
+            print(f"[{index}/{len(video_paths)}] {video_path.name} done in {seconds:.1f}s")
+        else:
+            failed[video_path] = error
+            print(f"[{index}/{len(video_paths)}] {video_path.name} FAILED: {error}")
+
+    if workers == 1:
+        # same budget in this process, OpenCV's thread count is restored afterwards
+        previous_threads = cv2.getNumThreads()
+        _init_batch_worker(threads)
+        try:
+            for index, video_path in enumerate(video_paths, start=1):
+                try:
+                    result = _handle_batch_video(video_path, video_args)
+                except Exception as error:
+                    report(index, video_path, error=_error_summary(error))
+                else:
+                    report(index, video_path, result=result)
+        finally:
+            cv2.setNumThreads(previous_threads)
+        return failed
+
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=_init_batch_worker,
+                             initargs=(threads,)) as executor:
+        futures = {executor.submit(_handle_batch_video, video_path, video_args): video_path
+                   for video_path in video_paths}
+        for index, future in enumerate(as_completed(futures), start=1):
+            try:
+                result = future.result()
+            except Exception as error:
+                report(index, futures[future], error=_error_summary(error))
+            else:
+                report(index, futures[future], result=result)
+    return failed
 
 
 def handle_single_file():
@@ -229,9 +684,24 @@ def handle_single_file():
     feather = 1  # softness of the new edge
     lower = (37, 40, 40)  # for removing the color
     upper = (85, 255, 255)  # for removing the color
-
-    # delete old folder if it exists
-    if output_folder.exists():
+    workers = None  # keying processes, None uses all cores
+    frame_cache = True  # decode once, re-runs with new thresholds key from data/cache/frames
+    key_threads = None  # keying threads when keying runs in this process (frame_cache), None uses all cores
+    ranges = None  # e.g. [(12.0, 17.0)] to only key these parts (seconds) instead of the whole clip
+    preview = False  # only write a low resolution contact sheet + stats to check the thresholds
+    resumable = False  # checkpoint keyed frames, a re-run after a crash continues where it stopped
+
+    if preview:
+        preview_video_file(input_path=video_path,
+                           output_path=output_folder,
+                           lower=lower,
+                           upper=upper,
+                           shrink_pixels=shrink_pixels,
+                           feather=feather)
+        return
+
+    # delete old folder if it exists (it holds the checkpoint of a resumable run)
+    if output_folder.exists() and not resumable:
         shutil.rmtree(output_folder)
     output_folder.mkdir(parents=True, exist_ok=True)
     handle_video_file(input_path=video_path,
@@ -241,7 +711,12 @@ def handle_single_file():
                       shrink_pixels=shrink_pixels,
                       feather=feather,
                       lower=lower,
-                      upper=upper)
+                      upper=upper,
+                      workers=workers,
+                      frame_cache=frame_cache,
+                      key_threads=key_threads,
+                      ranges=ranges,
+                      resumable=resumable)
 
 
 def handle_folder():
@@ -250,25 +725,33 @@ def handle_folder():
     upper = (85, 255, 255)  # for removing the color
     shrink_pixels = 1  # how many pixels to remove around the object
     feather = 1  # softness of the new edge
+    decoder = "ffmpeg"  # decode every video once in order instead of seeking per frame
+    profile = False  # per-stage timings of every video in output_folder/profile.jsonl
+    workers = None  # videos processed in parallel, None uses all cores
+    incremental = True  # skip videos that are unchanged since the last run (output_folder/manifest.json)
 
     data_path = current_path.joinpath("data", "secrete", "secrete")
     input_folder = data_path.joinpath("input_folder")
     output_folder = data_path.joinpath("output_folder")
 
-    for video_path in input_folder.glob("*.mp4"):
-        # output_folder = video_path.parent.joinpath(video_path.stem)
-
-        output_folder.mkdir(parents=True, exist_ok=True)
-        handle_video_file(input_path=video_path,
-                          output_path=output_folder,
-                          save_images=False,
-                          fps_out=fps_out,
-                          shrink_pixels=shrink_pixels,
-                          feather=feather,
-                          sape_png=True,
-                          save_gif=True,
-                          lower=lower,
-                          upper=upper)
+    output_folder.mkdir(parents=True, exist_ok=True)
+    manifest = BuildManifest(output_folder.joinpath(MANIFEST_FILE_NAME)) if incremental else None
+    failed = handle_video_files(input_folder.glob("*.mp4"),
+                                workers=workers,
+                                manifest=manifest,
+                                output_path=output_folder,
+                                save_images=False,
+                                fps_out=fps_out,
+                                shrink_pixels=shrink_pixels,
+                                feather=feather,
+                                sape_png=True,
+                                save_gif=True,
+                                lower=lower,
+                                upper=upper,
+                                decoder=decoder,
+                                profile_file=output_folder.joinpath("profile.jsonl") if profile else None)
+    for video_path, error in failed.items():
+        print(f"Failed: {video_path} ({error})")
 
 
 def main():
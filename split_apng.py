@@ -1,5 +1,7 @@
 import pathlib
 from PIL import Image
+from animation_writer import ApngWriter
+from build_manifest import MANIFEST_FILE_NAME, BuildManifest
 
 def add_marker_pixel(img: Image.Image) -> Image.Image:
     img = img.copy()
@@ -10,7 +12,8 @@ def update_timeing_in_apng(input_file: pathlib.Path,
                            output_file: pathlib.Path):
 
     im = Image.open(input_file)
-    animation_files = []
+    part_index = 0
+    part_files = []
     frames = []
     durations = []
 
@@ -26,7 +29,13 @@ def update_timeing_in_apng(input_file: pathlib.Path,
             durations.append(66)
             if duration_ms > 66:
                 if len(frames) > 1:
-                    animation_files.append([frames, durations])
+                    # write the finished part right away instead of keeping every part in memory
+                    file_path = output_file.parent.joinpath(f"{output_file.stem}_part_{part_index}.png")
+                    with ApngWriter(file_path, loop=0, delta=True) as writer:
+                        for part_frame, part_duration in zip(frames, durations):
+                            writer.write(part_frame, duration=part_duration)
+                    part_files.append(file_path)
+                    part_index += 1
                     frames = []
                     durations = []
 
@@ -34,16 +43,7 @@ def update_timeing_in_apng(input_file: pathlib.Path,
 
     except EOFError:
         pass
-    for af_index, af in enumerate(animation_files):
-        file_path = output_file.parent.joinpath(f"{output_file.stem}_part_{af_index}.png")
-        af[0][0].save(
-            file_path,
-            save_all=True,
-            append_images=af[0][1:],
-            duration=af[1],  # real durations in ms
-            loop=0,
-            format="PNG",
-        )
+    return part_files
 
 
 
@@ -51,13 +51,18 @@ def main():
     input_folder = pathlib.Path("data", "apng_animation", "input")
     output_folder = pathlib.Path("data", "apng_animation", "output")
     output_folder.mkdir(parents=True, exist_ok=True)
+    # inputs that are unchanged since their outputs were written are skipped
+    manifest = BuildManifest(output_folder.joinpath(MANIFEST_FILE_NAME))
     for input_file in input_folder.glob("*.png"):
+        if manifest.is_current(str(input_file), [input_file]):
+            continue
         new_file_name = input_file.stem + "_fixed.png"
         output_file = output_folder.joinpath(new_file_name)
-        update_timeing_in_apng(
+        outputs = update_timeing_in_apng(
             input_file=input_file,
             output_file=output_file
         )
+        manifest.record(str(input_file), [input_file], outputs=outputs)
 
 if __name__ == "__main__":
     main()